@@ -0,0 +1,159 @@
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import tempfile
+from tabulate import tabulate
+import constants
+import storage
+import profiling
+import synthetic_data
+import main as pipeline
+
+BENCHMARK_BASELINE_JSON = os.path.join(os.path.dirname(os.path.abspath(__file__)), "benchmark_baseline.json")
+
+
+def time_stage(timings, stage, run):
+    # wall and CPU seconds of run(), added up when a stage runs once per data source, and its peak RSS
+    # (the peak of the whole run so far where it can't be reset)
+    print(f"Benchmarking {stage}")
+    # memory the previous stage freed shouldn't count towards this one
+    storage.release_unused_memory()
+    profiling.reset_peak_rss()
+    start_wall, start_cpu = time.perf_counter(), time.process_time()
+    run()
+    timing = timings.setdefault(stage, {"wall_seconds": 0.0, "cpu_seconds": 0.0, "peak_rss_mb": 0.0})
+    timing["wall_seconds"] += time.perf_counter() - start_wall
+    timing["cpu_seconds"] += time.process_time() - start_cpu
+    timing["peak_rss_mb"] = max(timing["peak_rss_mb"], round(profiling.peak_rss_mb(), 1))
+
+
+def run_stages(workers=1):
+    """
+    Run the pipeline stages in the current directory, in the order of a full run, and time each of them.
+    """
+    os.makedirs(constants.DEDUPLICATE_BRAND_DIR, exist_ok=True)
+    timings = {}
+    time_stage(timings, "preprocess_data", lambda: pipeline.preprocess_data(workers, force=True))
+    for data_source in constants.DATA_SOURCES:
+        time_stage(timings, "get_brand_id_map", lambda: pipeline.get_brand_id_map(data_source))
+    for data_source in constants.DATA_SOURCES:
+        time_stage(timings, "match_brand_str_to_brand_id", lambda: pipeline.match_brand_str_to_brand_id(data_source))
+        time_stage(timings, "get_all_matches", pipeline.get_all_matches)
+        time_stage(timings, "clean_data", pipeline.clean_data)
+    time_stage(timings, "find_nearest_match", lambda: pipeline.find_nearest_match("iri"))
+    return timings
+
+
+def run_benchmark(rows, seed=0, workers=1, repeat=1, directory=None):
+    """
+    Generate a synthetic dataset and time the pipeline on fresh copies of it.
+    Keeps the fastest of `repeat` runs of each stage. Without a directory, the data is generated
+    in a temporary directory that is removed afterwards.
+    """
+    temporary = directory is None
+    directory = directory or tempfile.mkdtemp(prefix="brand_benchmark_")
+    source_directory = os.path.join(directory, "source")
+    print(f"Generating {rows} rows in {source_directory}")
+    row_counts = synthetic_data.generate(source_directory, rows, seed)
+    start_directory = os.getcwd()
+    stages = {}
+    try:
+        for run in range(repeat):
+            run_directory = os.path.join(directory, f"run_{run}")
+            shutil.rmtree(run_directory, ignore_errors=True)
+            shutil.copytree(source_directory, run_directory)
+            os.chdir(run_directory)
+            for stage, timing in run_stages(workers).items():
+                if stage not in stages or timing["wall_seconds"] < stages[stage]["wall_seconds"]:
+                    stages[stage] = timing
+            os.chdir(start_directory)
+    finally:
+        os.chdir(start_directory)
+        if temporary:
+            shutil.rmtree(directory, ignore_errors=True)
+    return {
+        "rows": sum(row_counts.values()),
+        "seed": seed,
+        "workers": workers,
+        "repeat": repeat,
+        "string_dtype": constants.STRING_DTYPE,
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "cpus": os.cpu_count(),
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "stages": stages,
+    }
+
+
+def compare_to_baseline(results, baseline, tolerance):
+    """
+    Print the wall time of every stage next to the baseline.
+    Returns the stages that got slower by more than tolerance (a fraction of the baseline time).
+    """
+    for setting in ("rows", "seed", "workers", "cpus", "string_dtype"):
+        if results.get(setting) != baseline.get(setting):
+            print(f"Warning: baseline was run with {setting}={baseline.get(setting)}, this run with {results.get(setting)}")
+    table = []
+    regressions = []
+    for stage, timing in results["stages"].items():
+        baseline_seconds = baseline["stages"].get(stage, {}).get("wall_seconds")
+        baseline_rss = baseline["stages"].get(stage, {}).get("peak_rss_mb")
+        if not baseline_seconds:
+            table.append([stage, None, round(timing["wall_seconds"], 3), None, None, timing["peak_rss_mb"], "new"])
+            continue
+        change = timing["wall_seconds"] / baseline_seconds - 1
+        status = "REGRESSION" if change > tolerance else "ok"
+        if change > tolerance:
+            regressions.append(stage)
+        table.append([stage, round(baseline_seconds, 3), round(timing["wall_seconds"], 3), f"{change:+.1%}",
+                      baseline_rss, timing["peak_rss_mb"], status])
+    print(tabulate(table, headers=["stage", "baseline (s)", "current (s)", "change",
+                                   "baseline peak RSS (MB)", "peak RSS (MB)", "status"]))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="time every pipeline stage on synthetic data")
+    parser.add_argument("--rows", type=int, default=100_000, help="number of brand rows (10k to 50M)")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--workers", type=int, default=1, help="--workers passed to preprocess_data")
+    parser.add_argument("--repeat", type=int, default=1, help="keep the fastest of this many runs of every stage")
+    parser.add_argument("--directory", help="where to generate the data, a temporary directory by default")
+    parser.add_argument("--output", default="benchmark_results.json", help="where to save the results")
+    parser.add_argument("--baseline", default=BENCHMARK_BASELINE_JSON, help="results to compare against")
+    parser.add_argument("--save_baseline", action="store_true", help="store the results as the new baseline")
+    parser.add_argument("--object_strings", action="store_true",
+                        help="keep brand and ASIN columns as Python objects (STRING_DTYPE = None), to compare memory")
+    parser.add_argument("--tolerance", type=float, default=0.2,
+                        help="slowdown over the baseline, as a fraction, that counts as a regression")
+    args = parser.parse_args()
+    if args.object_strings:
+        constants.STRING_DTYPE = None
+    output = os.path.abspath(args.output)
+    baseline_path = os.path.abspath(args.baseline)
+
+    results = run_benchmark(args.rows, args.seed, args.workers, args.repeat, args.directory)
+    with open(output, "w") as file:
+        json.dump(results, file, indent=4)
+    print(f"Benchmark results saved to {output}")
+
+    if args.save_baseline:
+        shutil.copyfile(output, baseline_path)
+        print(f"Baseline saved to {baseline_path}")
+    elif os.path.exists(baseline_path):
+        with open(baseline_path, "r") as file:
+            baseline = json.load(file)
+        regressions = compare_to_baseline(results, baseline, args.tolerance)
+        if regressions:
+            print(f"Slower than the baseline: {', '.join(regressions)}")
+            sys.exit(1)
+    else:
+        print(f"No baseline at {baseline_path}, run with --save_baseline to store one")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,132 @@
+import json
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import storage
+import profiling
+
+# one row per cluster. The brands list column is an offsets array into one array of all brand strings
+SCHEMA = pa.schema([
+    ("symbol_id", pa.int64()),
+    ("brand_id", pa.int64()),
+    ("brands", pa.large_list(pa.string())),
+])
+
+
+def format_id(value):
+    # ids as they are written in "symbol_id,brand_id" keys
+    return "None" if value is None else str(value)
+
+
+def parse_id(text):
+    return None if text == "None" else int(text)
+
+
+class ClusterStore:
+    """
+    symbol_id, brand_id -> brand strings clusters as Arrow columns: integer ids and the brand strings of each
+    cluster. Stored as an uncompressed Arrow IPC file, which is memory mapped when read instead of parsed,
+    and exported to JSON keyed by "symbol_id,brand_id" for people to read.
+    """
+
+    def __init__(self, table):
+        self.table = table
+
+    def __len__(self):
+        return self.table.num_rows
+
+    @classmethod
+    def from_frame(cls, df, symbol_column, brand_column, string_column):
+        """
+        One cluster per (symbol_id, brand_id) of df, with the brand strings of its rows sorted.
+        Rows missing either id are dropped, like groupby does.
+        """
+        df = df.dropna(subset=[symbol_column, brand_column])
+        df = df.sort_values([symbol_column, brand_column, string_column], kind="stable")
+        keys = df[[symbol_column, brand_column]].to_numpy(dtype=np.int64)
+        # a cluster starts wherever the ids change
+        starts = np.flatnonzero((np.diff(keys, axis=0) != 0).any(axis=1)) + 1
+        offsets = np.concatenate([[0], starts, [len(df)]]) if len(df) else np.zeros(1, dtype=np.int64)
+        return cls(pa.table({
+            "symbol_id": keys[offsets[:-1], 0],
+            "brand_id": keys[offsets[:-1], 1],
+            "brands": pa.LargeListArray.from_arrays(
+                pa.array(offsets, pa.int64()), pa.array(df[string_column].tolist(), pa.string())
+            ),
+        }, schema=SCHEMA))
+
+    @classmethod
+    def from_json_map(cls, clusters):
+        # a "symbol_id,brand_id" -> brand strings dict, e.g. manual_clusters.json
+        keys = [key.split(",") for key in clusters]
+        return cls(pa.table({
+            "symbol_id": [parse_id(symbol_id) for symbol_id, _ in keys],
+            "brand_id": [parse_id(brand_id) for _, brand_id in keys],
+            "brands": list(clusters.values()),
+        }, schema=SCHEMA))
+
+    @classmethod
+    def read(cls, path):
+        with profiling.timer("io"):
+            return cls(pa.ipc.open_file(pa.memory_map(path)).read_all())
+
+    def write(self, path):
+        with profiling.timer("io"):
+            with pa.OSFile(path, "wb") as sink, pa.ipc.new_file(sink, SCHEMA) as writer:
+                writer.write_table(self.table)
+            storage.write_metadata(path, len(self), {field.name: str(field.type) for field in SCHEMA})
+        return path
+
+    def to_json_map(self):
+        return {
+            f"{format_id(symbol_id)},{format_id(brand_id)}": brands
+            for symbol_id, brand_id, brands in zip(
+                self.table["symbol_id"].to_pylist(), self.table["brand_id"].to_pylist(), self.table["brands"].to_pylist()
+            )
+        }
+
+    def write_json(self, path):
+        with profiling.timer("io"):
+            with open(path, "w") as json_file:
+                json.dump(self.to_json_map(), json_file, indent=4)
+        return path
+
+    def merge(self, other):
+        """
+        The clusters of both stores. A cluster of other that is also in this one gets the brand strings
+        of both, sorted, in its place; the others are added at the end.
+        Untouched clusters are slices of this store's columns rather than copies.
+        """
+        if not len(other):
+            return self
+        id_columns = ["symbol_id", "brand_id"]
+        positions = other.table.select(id_columns).to_pandas().merge(
+            self.table.select(id_columns).to_pandas().reset_index(), how="left", on=id_columns
+        )["index"]
+        shared = {int(position): row for row, position in enumerate(positions) if pd.notna(position)}
+        brands_column = SCHEMA.get_field_index("brands")
+        pieces, start = [], 0
+        for position in sorted(shared):
+            pieces.append(self.table.slice(start, position - start))
+            brands = self.table["brands"][position].as_py() + other.table["brands"][shared[position]].as_py()
+            pieces.append(self.table.slice(position, 1).set_column(
+                brands_column, SCHEMA.field("brands"), pa.array([sorted(brands)], SCHEMA.field("brands").type)
+            ))
+            start = position + 1
+        pieces.append(self.table.slice(start))
+        pieces.append(other.table.take(np.flatnonzero(positions.isna().to_numpy())))
+        return ClusterStore(pa.concat_tables(pieces))
+
+    def flatten(self):
+        """
+        (brand strings, brand ids, symbol ids) lists with one entry per brand string, cluster by cluster.
+        """
+        lengths = pc.list_value_length(self.table["brands"]).to_numpy()
+
+        def repeat_ids(column):
+            ids = self.table[column]
+            if ids.null_count:
+                return ids.take(pa.array(np.repeat(np.arange(len(self)), lengths))).to_pylist()
+            return np.repeat(ids.to_numpy(), lengths).tolist()
+        return pc.list_flatten(self.table["brands"]).to_pylist(), repeat_ids("brand_id"), repeat_ids("symbol_id")
@@ -13,17 +13,84 @@ BRANDS_THAT_MATCH_CSV = os.path.join(MAPPINGS_DIRECTORY, "brands_that_match.csv"
 MANUAL_CLUSTERS_JSON = os.path.join(MAPPINGS_DIRECTORY, "manual_clusters.json")
 CLOSEST_BRANDS_CSV = os.path.join(MAPPINGS_DIRECTORY, "closest_brands.csv")
 DELIVERABLE_MAPPED_BRANDS_CSV = os.path.join(MAPPINGS_DIRECTORY, "deliverable_mapped_brands.csv")
+SALES_RANK_CSV = os.path.join(MAPPINGS_DIRECTORY, "Nov 2024 BV product_brand_id sales - sales rank.csv")
+# content hashes of what each stage read and wrote on its last run
+RUN_MANIFEST_JSON = os.path.join(MAPPINGS_DIRECTORY, "run_manifest.json")
+# default trace of --profile
+PROFILE_TRACE_JSON = "profile_trace.json"
 
 HELIOS_COVERAGE_MD = os.path.join(DOCS_DIR, "helios_coverage.md")
+# processes rendering the charts of create_graphs.py
+GRAPH_WORKERS = os.cpu_count() or 1
 
+# Format of the tables in DATA_DIRECTORY and DEDUPLICATE_BRAND_DIR: "parquet" or "csv".
+# Files are still named by their .csv path, storage.table_path swaps the extension.
+# Deliverables in MAPPINGS_DIRECTORY are always CSV
+STORAGE_FORMAT = "parquet"
+PARQUET_COMPRESSION = "zstd"
+
+# dtype of the string columns (brand, asin) of the tables read through storage.read_table.
+# Arrow strings take a fraction of the memory of one Python object per value. None keeps object columns
+STRING_DTYPE = "string[pyarrow]"
+
+# Memory budget of the bucket tables a run keeps loaded (storage.BucketStore).
+# The least recently used tables are dropped, and re-read if needed again, once it is exceeded
+BUCKET_CACHE_BYTES = 4 * 2 ** 30
+
+# get_sql_results: rows per streamed result page, and queries in flight at once
+EXTRACT_PAGE_SIZE = 500_000
+MAX_CONCURRENT_QUERIES = 8
+# Local cache of query results (query_client.CachedQueryClient): results are reused for
+# QUERY_CACHE_TTL_SECONDS unless --refresh is passed. None turns the cache off
+QUERY_CACHE_DIR = ".query_cache"
+QUERY_CACHE_TTL_SECONDS = 24 * 3600
+QUERY_CACHE_COMPRESSION = "zstd"
+# shard fingerprints of every prefix as of its last incremental extraction
+EXTRACT_WATERMARKS_JSON = os.path.join(DATA_DIRECTORY, "extract_watermarks.json")
+
+# Matching engine: number of cores given to rapidfuzz (-1 uses all of them)
+# and the largest query x choice score matrix computed at once
+MATCH_WORKERS = -1
+MATCH_CHUNK_CELLS = 10_000_000
+# Jaro-Winkler distance accepted by match_brand_str_to_brand_id. 0.0 only accepts exact
+# matches, which are resolved through a hash index instead of scanning the bucket
+EXACT_MATCH_CUTOFF = 0.0
+# find_nearest_match: up to NEAREST_MATCH_LIMIT brands within NEAREST_MATCH_CUTOFF Jaro-Winkler distance.
+# Searching all buckets also finds brands whose first character differs
+NEAREST_MATCH_CUTOFF = 0.15
+NEAREST_MATCH_LIMIT = 10
+NEAREST_MATCH_SEARCH_ALL_BUCKETS = False
+# "blocking" scores every brand that can be within the cutoff. "cdist" scores chunks of
+# NEAREST_MATCH_QUERY_CHUNK brand strings against whole buckets on MATCH_WORKERS cores.
+# "tfidf" only re-scores the NEAREST_MATCH_NGRAM_CANDIDATES brands with the most similar character n-grams:
+# approximate, but its cost doesn't grow with the bucket size for every query, and it searches
+# all buckets through one index
+NEAREST_MATCH_ENGINE = "blocking"
+NEAREST_MATCH_QUERY_CHUNK = 1000
+NEAREST_MATCH_NGRAM_CANDIDATES = 200
+# closest_brands.csv is written in sorted runs of this many rows, merged at the end
+NEAREST_MATCH_RUN_ROWS = 1_000_000
+# Results of the fuzzy matches by query string and bucket content hash, reused across runs
+# for the brand strings and buckets that didn't change (None turns the cache off)
+MATCH_CACHE_DB = os.path.join(MAPPINGS_DIRECTORY, "match_cache.sqlite")
+
+
+def get_source_brands_file(df_name):
+    return os.path.join(MAPPINGS_DIRECTORY, f"Nov 2024 BV product_brand_id sales - {df_name}.csv")
 
 def get_brand_clusters_file(df_name):
     return os.path.join(MAPPINGS_DIRECTORY, f"symbol_brand_brandstring_clusters_{df_name}.json")
 
+def get_brand_cluster_store_file(df_name):
+    # the clusters as read by the pipeline; the JSON file is an export of it
+    return os.path.join(MAPPINGS_DIRECTORY, f"symbol_brand_brandstring_clusters_{df_name}.arrow")
+
 def DUPLICATE_FILE(prefix):
     return os.path.join(DEDUPLICATE_BRAND_DIR, f"{prefix}_duplicates.csv")
 def PREPROCESSED_FILE(prefix):
     return os.path.join(DEDUPLICATE_BRAND_DIR, f'{prefix}_preprocessed.csv')
+def BRAND_COUNT_FILE(prefix):
+    return os.path.join(DEDUPLICATE_BRAND_DIR, f"{prefix}_brand_count_index.csv")
 MISC_NAME = "misc"
 BRAND_PREFIX_TO_FILE_NAME = {
     "A": "A_brands.csv",
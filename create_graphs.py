@@ -1,10 +1,16 @@
-from google.cloud import bigquery
 import pandas as pd
+import matplotlib
+# render straight to PNG, without a GUI event loop
+matplotlib.use("Agg")
 import matplotlib.pyplot as plt
 import argparse
 import os
+import gc
+from concurrent.futures import ProcessPoolExecutor, as_completed
 import constants
+import profiling
 import numpy as np
+from query_client import get_client, run_queries
 
 brand_id_to_name = {
     29631: "KIMBERLY-CLARK CORPORATION",
@@ -33,8 +39,8 @@ brand_id_to_name = {
     29050: "BEIERSDORF"
 }
 
-client = bigquery.Client()
-def generate_before_after_graphs():
+@profiling.stage("generate_before_after_graphs")
+def generate_before_after_graphs(client=None, workers=constants.GRAPH_WORKERS):
     before_mapping_query = """
 SELECT 
     product_brand_id,
@@ -90,19 +96,37 @@ WHERE
 GROUP BY product_brand_id, quarter
 ORDER BY product_brand_id, quarter;
 """
-    after_mapping_df = client.query(after_mapping_query).to_dataframe()
-    before_mapping_df = client.query(before_mapping_query).to_dataframe()
+    # both queries run concurrently
+    with profiling.timer("query"):
+        results = run_queries({"after_mapping": after_mapping_query, "before_mapping": before_mapping_query}, client)
+    after_mapping_df, before_mapping_df = results["after_mapping"], results["before_mapping"]
+    profiling.current_span()["rows_in"] = len(after_mapping_df) + len(before_mapping_df)
     after_mapping_df['quarter'] = pd.to_datetime(after_mapping_df['quarter'], errors='coerce')
     before_mapping_df['quarter'] = pd.to_datetime(before_mapping_df['quarter'], errors='coerce')
 
     assert set(before_mapping_df['product_brand_id'].unique()) == set(
         after_mapping_df['product_brand_id'].unique()), "The brand IDs must be identical for comparison."
-    unique_brands = before_mapping_df['product_brand_id'].unique()
 
-    # Create a separate bar chart for each product_brand_id showing both before and after mapping
-    for brand_id in unique_brands:
-        before_brand_df = before_mapping_df[before_mapping_df['product_brand_id'] == brand_id]
-        after_brand_df = after_mapping_df[after_mapping_df['product_brand_id'] == brand_id]
+    # Create a separate bar chart for each product_brand_id showing both before and after mapping,
+    # from frames split by brand once
+    after_by_brand = dict(tuple(after_mapping_df.groupby('product_brand_id', sort=False)))
+    jobs = [
+        (render_before_after, (brand_id, before_brand_df, after_by_brand[brand_id],
+                               os.path.join(constants.GRAPHS_DIR, f"{brand_id_to_name[brand_id]}.png")))
+        for brand_id, before_brand_df in before_mapping_df.groupby('product_brand_id', sort=False)
+    ]
+    render_charts(jobs, workers)
+
+
+def close_figure(figure):
+    # a closed figure and its render buffers are reference cycles, which the garbage collector
+    # only gets to after many more allocations: collect them now so memory stays flat across charts
+    plt.close(figure)
+    gc.collect()
+
+
+def render_before_after(brand_id, before_brand_df, after_brand_df, file_path):
+    with profiling.span("graph", detached=True, brand_id=int(brand_id)) as graph_span:
         # Sort by quarter for proper alignment
         before_brand_df = before_brand_df.sort_values('quarter')
         after_brand_df = after_brand_df.sort_values('quarter')
@@ -110,25 +134,64 @@ ORDER BY product_brand_id, quarter;
         quarter_labels = [q.to_period('Q').strftime('%YQ%q') for q in common_quarters]
         bar_width = 0.4
         x_indexes = np.arange(len(common_quarters))
-        plt.figure(figsize=(10, 5))
+        figure, axes = plt.subplots(figsize=(10, 5))
+
+        axes.bar(x_indexes - bar_width / 2,
+                 before_brand_df.set_index('quarter').reindex(common_quarters)['total_price_paid'].fillna(0),
+                 width=bar_width, color='blue', alpha=0.6, label="Before Mapping")
+        axes.bar(x_indexes + bar_width / 2,
+                 after_brand_df.set_index('quarter').reindex(common_quarters)['total_price_paid'].fillna(0),
+                 width=bar_width, color='orange', alpha=0.6, label="After Mapping")
+        axes.set_xlabel("Quarter")
+        axes.set_ylabel("Total Price Paid")
+        axes.set_title(f"Total Price Paid by Quarter for {brand_id_to_name[brand_id]} {brand_id}")
+        axes.set_xticks(x_indexes, quarter_labels, rotation=45)
+        axes.legend()
+
+        with profiling.timer("io"):
+            figure.savefig(file_path, dpi=300, bbox_inches='tight')
+        close_figure(figure)
+        graph_span["rows_in"] = len(before_brand_df) + len(after_brand_df)
+    return graph_span if profiling.is_enabled() else None
+
 
-        plt.bar(x_indexes - bar_width / 2,
-                before_brand_df.set_index('quarter').reindex(common_quarters)['total_price_paid'].fillna(0),
-                width=bar_width, color='blue', alpha=0.6, label="Before Mapping")
-        plt.bar(x_indexes + bar_width / 2,
-                after_brand_df.set_index('quarter').reindex(common_quarters)['total_price_paid'].fillna(0),
-                width=bar_width, color='orange', alpha=0.6, label="After Mapping")
-        plt.xlabel("Quarter")
-        plt.ylabel("Total Price Paid")
-        plt.title(f"Total Price Paid by Quarter for {brand_id_to_name[brand_id]} {brand_id}")
-        plt.xticks(x_indexes, quarter_labels, rotation=45)
-        plt.legend()
+def render_purina_batch(batch, batch_pivot, file_path):
+    with profiling.span("graph", detached=True, batch=batch) as graph_span:
+        figure, axes = plt.subplots(figsize=(12, 6))
+        for brand in batch_pivot.columns:
+            axes.plot(batch_pivot.index, batch_pivot[brand], label=brand, marker='o')
+
+        axes.set_xlabel("Quarter")
+        axes.set_ylabel("Total Price Paid")
+        axes.set_title(f"Total Sales by Quarter for PURINA Brands (Batch {batch})")
+        axes.legend(loc='upper left', bbox_to_anchor=(1, 1))
+        axes.tick_params(axis="x", labelrotation=45)
+        figure.tight_layout()
 
-        file_path = os.path.join("graphs", f"{brand_id_to_name[brand_id]}.png")
-        plt.savefig(file_path, dpi=300, bbox_inches='tight')
+        with profiling.timer("io"):
+            figure.savefig(file_path, dpi=300, bbox_inches='tight')
+        close_figure(figure)
+        graph_span["rows_in"] = int(batch_pivot.notna().sum().sum())
+    return graph_span if profiling.is_enabled() else None
 
 
-def purina():
+def render_charts(jobs, workers=1):
+    """
+    Run (render function, arguments) chart jobs, in a pool of `workers` processes when there is more than one.
+    Each job gets only the rows of its own chart. Their profiles are attached to the current span.
+    """
+    if workers > 1 and len(jobs) > 1:
+        with ProcessPoolExecutor(max_workers=min(workers, len(jobs))) as executor:
+            futures = [executor.submit(render, *arguments) for render, arguments in jobs]
+            for future in as_completed(futures):
+                profiling.add_span(future.result())
+    else:
+        for render, arguments in jobs:
+            profiling.add_span(render(*arguments))
+
+
+@profiling.stage("purina")
+def purina(client=None, workers=constants.GRAPH_WORKERS):
     query = """
 WITH brand_mapping AS (
     -- First attempt: Join on product_brand
@@ -176,7 +239,9 @@ GROUP BY product_brand, quarter
 ORDER BY product_brand, quarter;
     """
 
-    purina_df = client.query(query).to_dataframe()
+    with profiling.timer("query"):
+        purina_df = get_client(client).query_dataframe(query)
+    profiling.current_span()["rows_in"] = len(purina_df)
     purina_df["quarter"] = pd.to_datetime(purina_df["quarter"])
     purina_graph_dir = os.path.join(constants.GRAPHS_DIR, "PURINA")
 
@@ -184,27 +249,20 @@ ORDER BY product_brand, quarter;
     unique_purina_brands_filtered = purina_df_filtered["product_brand"].unique()
     batch_size = 10
 
-    # Generate multi-line plots in batches of 10 brands
+    # Generate multi-line plots in batches of 10 brands, sliced from one pivot of all of them.
+    # A batch keeps the quarters its brands have rows in, even rows without sales, as if it was pivoted on its own
+    purina_pivot = purina_df_filtered.pivot(index="quarter", columns="product_brand", values="total_price_paid")
+    has_row = purina_df_filtered.assign(has_row=True).pivot(
+        index="quarter", columns="product_brand", values="has_row"
+    ).notna()
+    jobs = []
     for i in range(0, len(unique_purina_brands_filtered), batch_size):
         batch_brands = unique_purina_brands_filtered[i:i + batch_size]
-        batch_df = purina_df_filtered[purina_df_filtered["product_brand"].isin(batch_brands)]
-
-        # Pivot DataFrame to reshape for multiple line plotting
-        batch_pivot = batch_df.pivot(index="quarter", columns="product_brand", values="total_price_paid")
-        plt.figure(figsize=(12, 6))
-        for brand in batch_pivot.columns:
-            plt.plot(batch_pivot.index, batch_pivot[brand], label=brand, marker='o')
-
-        plt.xlabel("Quarter")
-        plt.ylabel("Total Price Paid")
-        plt.title(f"Total Sales by Quarter for PURINA Brands (Batch {i // batch_size + 1})")
-        plt.legend(loc='upper left', bbox_to_anchor=(1, 1))
-        plt.xticks(rotation=45)
-        plt.tight_layout()
-
+        batch_columns = purina_pivot.columns.isin(batch_brands)
+        batch_pivot = purina_pivot.loc[has_row.loc[:, batch_columns].any(axis=1), batch_columns]
         file_path = os.path.join(purina_graph_dir, f"purina_batch_{i // batch_size + 1}.png")
-        plt.savefig(file_path, dpi=300, bbox_inches='tight')
-
+        jobs.append((render_purina_batch, (i // batch_size + 1, batch_pivot, file_path)))
+    render_charts(jobs, workers)
 
 
 def main():
@@ -220,11 +278,35 @@ def main():
         action="store_true",
         help="preprocess the data",
     )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=constants.GRAPH_WORKERS,
+        help="number of processes rendering charts in parallel",
+    )
+    parser.add_argument(
+        "--refresh",
+        action="store_true",
+        help="rerun the queries instead of using their cached results",
+    )
+    parser.add_argument(
+        "--profile",
+        nargs="?",
+        const=constants.PROFILE_TRACE_JSON,
+        help=f"write per graph timings and row counts to a JSON trace ({constants.PROFILE_TRACE_JSON} by default)",
+    )
+    parser.add_argument(
+        "--profile_stacks",
+        help="with --profile, also sample call stacks and write them here in folded (flamegraph) format",
+    )
     args = parser.parse_args()
+    if args.profile:
+        profiling.enable(args.profile, args.profile_stacks)
+    client = get_client(refresh=args.refresh)
     if args.before_after:
-        generate_before_after_graphs()
+        generate_before_after_graphs(client, workers=args.workers)
     if args.purina:
-        purina()
+        purina(client, workers=args.workers)
 
 
 if __name__ == "__main__":
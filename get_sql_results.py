@@ -1,10 +1,22 @@
 import os
+import json
+import time
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+import pandas as pd
 import constants
-from google.cloud import bigquery
+import storage
+from query_client import get_client, uncached
 
-client = bigquery.Client()
+BRAND_COLUMNS = ["brand", "asin"]
+# Incremental extraction splits every prefix into shards by the last two characters of the ASIN,
+# which are evenly spread. Server-side versions of get_brand_prefixes and get_asin_shards
+PREFIX_SQL = f"IF(REGEXP_CONTAINS(UPPER(brand), r'^[A-Z]'), SUBSTR(UPPER(brand), 1, 1), '{constants.MISC_NAME}')"
+SHARD_SQL = "IFNULL(SUBSTR(asin, -2), '')"
 
-def get_brands_url_by_letter(letter):
+
+def get_brands_url_query(brand_filter, final_select="SELECT brand, asin FROM brands"):
+    # Poseidon brand strings and their ASINs, restricted by brand_filter, as the brands table of final_select
     sql_query = f"""
     CREATE TEMP FUNCTION is_amzn_media(asin STRING, byline STRING)
     RETURNS BOOL
@@ -48,8 +60,9 @@ def get_brands_url_by_letter(letter):
       INNER JOIN `cei-data-science.dev_cpd_products_dbt.product_sources` c USING (source_id)
       WHERE
         source_id <> 100091 OR b.product_id IS NULL
-    )
+    ),
     
+    brands AS (
     select distinct
       a.brand,
       c.product_code asin,
@@ -74,108 +87,233 @@ def get_brands_url_by_letter(letter):
     
     where
       a.category_id is not null
-      AND UPPER(a.brand) LIKE '{letter}%';
+      AND {brand_filter}
+    )
+
+    {final_select};
     """
     return sql_query
 
+def get_brands_url_by_letter(letter):
+    return get_brands_url_query(f"UPPER(a.brand) LIKE '{letter}%'")
+
 def get_brands_url_not_a_to_z():
     # Base SQL query for brands not starting with A-Z
-    sql_query = """
-    CREATE TEMP FUNCTION is_amzn_media(asin STRING, byline STRING)
-    RETURNS BOOL
-    AS (
-      SAFE_CAST(LEFT(asin, 9) AS INT) IS NOT NULL  -- ISBN 10 with or without check digit
-      OR REGEXP_CONTAINS(byline, '(Format:)|(Rated:)|(Formato:)|(Clasificado:)')
-      OR REGEXP_CONTAINS(byline, r'(^by)|(^.*? by)[A-Z]')  -- e.g., "byOscar Wilde". Capital to minimize false positives
-      OR REGEXP_CONTAINS(byline, r'\(.*?\)')  -- Broad, so chance for false positives, but small amount selected
-    );
-    
-    WITH amzn_media AS (
-      SELECT 
-        * 
-      FROM `cei-data-science.webscrape.amzn_product_data`
-      WHERE 
-        is_amzn_media(url_asin, byline) OR is_amzn_media(parsed_asin, byline)
-    ),
-    
-    amzn_media_asins AS (
-      SELECT DISTINCT url_asin AS asin FROM amzn_media
-      UNION DISTINCT
-      SELECT DISTINCT parsed_asin AS asin FROM amzn_media
-    ),
-    
-    amzn_media_product_ids AS (
-      SELECT
-        a.product_id,
-        a.product_code
-      FROM `cei-de-platform.helios_pipeline_product_tagging.product_codes` a
-      INNER JOIN amzn_media_asins b
-      ON a.product_code = b.asin
-    ),
-    
-    products_full_no_amzn_media AS (
-      SELECT
-        a.*,
-        b.product_code,
-        c.source
-      FROM `cei-de-platform.helios_pipeline_product_tagging.products_full` a
-      LEFT JOIN amzn_media_product_ids b USING (product_id)
-      INNER JOIN `cei-data-science.dev_cpd_products_dbt.product_sources` c USING (source_id)
-      WHERE
-        source_id <> 100091 OR b.product_id IS NULL
-    )
-    
-    
-    select distinct
-      a.brand,
-      c.product_code asin,
-    
-    -- start with product_catalog, since these are the brand strings that get propogated to the client-facing tables
-    from `cei-de-platform.helios_pipeline_product_tagging.product_catalog` a 
-    
-    -- inner join on just Posiedon Amazon data, but excuding Amazon media
-    inner join (
-      select * from products_full_no_amzn_media
-      where source_id = 100091  -- filter to product_ids from Amazon poseidon data
-    ) b using (product_id)
-    
-    -- bring in all ASINs associated with each product_id (multiple ASINs can be group together under a single product_id)
-    left join (
-      select
-        product_id,
-        product_code
-      from `cei-de-platform.helios_pipeline_product_tagging.product_codes`
-      where product_code_type = 'asin'
-    ) c using (product_id)
-    
-    WHERE   
-        a.category_id IS NOT NULL
-        AND NOT REGEXP_CONTAINS(UPPER(a.brand), r'^[A-Z]');
+    return get_brands_url_query("NOT REGEXP_CONTAINS(UPPER(a.brand), r'^[A-Z]')")
+
+def get_brands_url_all():
+    # Every brand the per-prefix queries return between them: NULL brands match none of them
+    return get_brands_url_all_query("SELECT brand, asin FROM brands")
+
+
+def get_shard_fingerprints_query():
+    # row count and order-independent fingerprint of every shard of every prefix
+    return get_brands_url_all_query(f"""
+    SELECT
+      {PREFIX_SQL} AS prefix,
+      {SHARD_SQL} AS shard,
+      COUNT(*) AS row_count,
+      BIT_XOR(FARM_FINGERPRINT(CONCAT(brand, '|', IFNULL(asin, '')))) AS fingerprint
+    FROM brands
+    GROUP BY prefix, shard""")
+
+def get_shard_rows_query(changed_shards):
+    # the rows of the given shards, with their prefix. None in place of a prefix's shards selects all of them
+    whole_prefixes = [prefix for prefix, shards in changed_shards.items() if shards is None]
+    shard_keys = [f"{prefix}:{shard}" for prefix, shards in changed_shards.items() if shards for shard in shards]
+    return get_brands_url_all_query(f"""
+    SELECT {PREFIX_SQL} AS prefix, brand, asin
+    FROM brands
+    WHERE {PREFIX_SQL} IN ({sql_strings(whole_prefixes)})
+      OR CONCAT({PREFIX_SQL}, ':', {SHARD_SQL}) IN ({sql_strings(shard_keys)})""")
+
+def get_brands_url_all_query(final_select):
+    return get_brands_url_query("a.brand IS NOT NULL", final_select)
+
+def sql_strings(values):
+    # comma separated BigQuery string literals, NULL for none so that IN () stays valid
+    if not values:
+        return "NULL"
+    return ", ".join("'" + value.replace("\\", "\\\\").replace("'", "\\'") + "'" for value in values)
+
+
+def get_brand_prefixes(brands):
     """
-    return sql_query
+    Client-side version of the per-prefix filters: the letter a brand's upper-cased form starts with,
+    or MISC_NAME for everything else
+    """
+    first_characters = brands.str[:1].str.upper().str[:1]
+    is_letter = first_characters.isin(list("ABCDEFGHIJKLMNOPQRSTUVWXYZ"))
+    return first_characters.where(is_letter, constants.MISC_NAME)
+
+
+def get_asin_shards(asins):
+    return asins.fillna("").astype(str).str[-2:]
+
+
+def load_watermarks():
+    """
+    Shard row counts and fingerprints of every prefix as of its last extraction.
+    """
+    if os.path.exists(constants.EXTRACT_WATERMARKS_JSON):
+        with open(constants.EXTRACT_WATERMARKS_JSON, "r") as file:
+            return json.load(file)
+    return {}
 
 
-def get_brands_url_data():
+def save_watermarks(watermarks):
+    with open(constants.EXTRACT_WATERMARKS_JSON, "w") as file:
+        json.dump(watermarks, file, indent=4, sort_keys=True)
+
+
+def get_changed_shards(watermarks, fingerprints):
+    """
+    prefix -> shards whose rows were added or removed since the watermark, or None when the prefix has no
+    watermark yet and is extracted in full. Prefixes without changes are left out.
+    """
+    changed_shards = {}
+    for prefix in constants.BRAND_PREFIX_TO_FILE_NAME:
+        if prefix not in watermarks:
+            changed_shards[prefix] = None
+            continue
+        known = watermarks[prefix]["shards"]
+        current = fingerprints.get(prefix, {})
+        shards = sorted(shard for shard in set(known) | set(current) if known.get(shard) != current.get(shard))
+        if shards:
+            changed_shards[prefix] = shards
+    return changed_shards
+
+
+def get_brands_url_data_incremental(client=None, page_size=constants.EXTRACT_PAGE_SIZE):
+    """
+    Only fetch the shards whose rows changed since the last extraction and merge them into the prefix files.
+    A first query fingerprints every shard, a second one fetches the changed shards. Unchanged prefix files
+    aren't rewritten, so preprocess_data skips their buckets.
+    Returns the prefixes that were updated.
+    """
+    # both queries always go to the server: the fingerprint query has the same text on every run,
+    # so a cached result would hide the changes made since
+    client = uncached(get_client(client))
+    watermarks = load_watermarks()
+    fingerprints = {}
+    for page in client.query_pages(get_shard_fingerprints_query(), page_size=page_size):
+        for prefix, shard, row_count, fingerprint in page[["prefix", "shard", "row_count", "fingerprint"]].itertuples(index=False):
+            fingerprints.setdefault(prefix, {})[shard] = [int(row_count), int(fingerprint)]
+    changed_shards = get_changed_shards(watermarks, fingerprints)
+    if not changed_shards:
+        print("No brand or ASIN changes since the last extraction.")
+        return []
+
+    pages_by_prefix = {prefix: [] for prefix in changed_shards}
+    for page in client.query_pages(get_shard_rows_query(changed_shards), page_size=page_size):
+        for prefix, rows in page[page["brand"].notna()].groupby("prefix"):
+            if prefix in pages_by_prefix:
+                pages_by_prefix[prefix].append(rows[BRAND_COLUMNS])
+
+    extracted = time.strftime("%Y-%m-%dT%H:%M:%S")
+    for prefix, shards in changed_shards.items():
+        path = os.path.join(constants.DATA_DIRECTORY, constants.BRAND_PREFIX_TO_FILE_NAME[prefix])
+        delta_df = pd.concat(pages_by_prefix[prefix], ignore_index=True) if pages_by_prefix[prefix] \
+            else pd.DataFrame(columns=BRAND_COLUMNS)
+        if shards is None or not os.path.exists(storage.existing_path(path)):
+            df = delta_df
+        else:
+            # rows of the changed shards are replaced, the others are kept as they are
+            df = storage.read_table(path, columns=BRAND_COLUMNS)
+            df = pd.concat([df[~get_asin_shards(df["asin"]).isin(shards)], delta_df], ignore_index=True)
+        file_path = storage.write_table(df, path)
+        watermarks[prefix] = {"extracted": extracted, "shards": fingerprints.get(prefix, {})}
+        changed = "all" if shards is None else len(shards)
+        print(f"Updated {file_path}: {changed} changed shards, {len(delta_df)} rows fetched, {len(df)} rows")
+    # only saved once the files are written, so an interrupted run fetches the same shards again
+    save_watermarks(watermarks)
+    print(f"Updated {len(changed_shards)} of {len(constants.BRAND_PREFIX_TO_FILE_NAME)} prefix files.")
+    return list(changed_shards)
+
+
+def get_brands_url_data_single_scan(client=None, page_size=constants.EXTRACT_PAGE_SIZE):
+    """
+    Evaluate the extraction query once for all brands and split the rows into the prefix files
+    as pages stream in.
+    """
+    client = get_client(client)
+    writers = {
+        key: storage.TableWriter(os.path.join(constants.DATA_DIRECTORY, file_name), BRAND_COLUMNS)
+        for key, file_name in constants.BRAND_PREFIX_TO_FILE_NAME.items()
+    }
+    for page in client.query_pages(get_brands_url_all(), page_size=page_size):
+        page = page[page["brand"].notna()]
+        for key, rows in page.groupby(get_brand_prefixes(page["brand"])):
+            writers[key].write(rows)
+
     counter = 0
-    for letter in "ABCDEFGHIJKLMNOPQRSTUVWXYZ":
-        query = get_brands_url_by_letter(letter)
-        query_job = client.query(query)
-        df = query_job.to_dataframe()
-
-        file_name = f"{letter}_brands.csv"
-        file_path = os.path.join(constants.DATA_DIRECTORY, file_name)
-        df.to_csv(file_path, index=False)
-        counter += df.shape[0]
-        print(f"Saved results for letter {letter} to {file_path}")
-
-    query = get_brands_url_not_a_to_z()
-    query_job = client.query(query)
-    df = query_job.to_dataframe()
-    counter += df.shape[0]
-    file_name = "misc.csv"
-    file_path = os.path.join(constants.DATA_DIRECTORY, file_name)
-    df.to_csv(file_path, index=False)
-    print(f"Saved results for non-A-Z brands to {file_path}")
+    for key, writer in writers.items():
+        file_path = writer.close()
+        counter += writer.rows
+        if key == constants.MISC_NAME:
+            print(f"Saved results for non-A-Z brands to {file_path}")
+        else:
+            print(f"Saved results for letter {key} to {file_path}")
     print(f"Obtained {counter} entries.")
 
-get_brands_url_data()
\ No newline at end of file
+
+def get_brands_url_data(client=None, max_workers=constants.MAX_CONCURRENT_QUERIES):
+    """
+    One query per prefix file, with up to max_workers queries in flight at once.
+    """
+    client = get_client(client)
+
+    def extract(key, file_name):
+        if key == constants.MISC_NAME:
+            query = get_brands_url_not_a_to_z()
+        else:
+            query = get_brands_url_by_letter(key)
+        df = client.query_dataframe(query)
+        file_path = storage.write_table(df, os.path.join(constants.DATA_DIRECTORY, file_name))
+        return df.shape[0], file_path
+
+    counter = 0
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {
+            key: executor.submit(extract, key, file_name)
+            for key, file_name in constants.BRAND_PREFIX_TO_FILE_NAME.items()
+        }
+        for key, future in futures.items():
+            rows, file_path = future.result()
+            counter += rows
+            if key == constants.MISC_NAME:
+                print(f"Saved results for non-A-Z brands to {file_path}")
+            else:
+                print(f"Saved results for letter {key} to {file_path}")
+    print(f"Obtained {counter} entries.")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="extract Poseidon brand strings into the prefix files")
+    parser.add_argument(
+        "--per_prefix_queries",
+        action="store_true",
+        help="run one query per prefix file (concurrently) instead of a single scan",
+    )
+    parser.add_argument(
+        "--incremental",
+        action="store_true",
+        help="only fetch the rows added or removed since the last extraction and merge them into the prefix files",
+    )
+    parser.add_argument(
+        "--refresh",
+        action="store_true",
+        help="rerun the queries instead of using their cached results",
+    )
+    args = parser.parse_args()
+    client = get_client(refresh=args.refresh)
+    if args.incremental:
+        get_brands_url_data_incremental(client)
+    elif args.per_prefix_queries:
+        get_brands_url_data(client)
+    else:
+        get_brands_url_data_single_scan(client)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,48 +1,137 @@
 import os
 import argparse
+import itertools
 import constants
+import matching
+import storage
+import manifest
+import profiling
+import match_cache
+import clusters
+import numpy as np
 import pandas as pd
 import json
 from google.cloud import bigquery
+from query_client import CachedQueryClient, get_client, run_queries
 from rapidfuzz import process, distance
-from rapidfuzz.process import extractOne, extract
+from rapidfuzz.process import extract
 import unicodedata
 import re
 from tabulate import tabulate
 import pprint
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import pyarrow as pa
+import pyarrow.compute as pc
 os.makedirs(constants.DEDUPLICATE_BRAND_DIR, exist_ok=True)
 
 def read_data(file_name):
-    return pd.read_csv(file_name)
+    with profiling.timer("io"):
+        return pd.read_csv(file_name)
 
-def create_duplicate_csv(df):
-    duplicates = []
-    for brand, group in df.groupby("brand"):
-        if len(group) > 1:
-            for index, row in group.iterrows():
-                duplicates.append({"brand": brand, "unprocessed_index": index, "asin": row["asin"]})
+def split_duplicates(df):
+    """
+    Stable sort by brand once, then split the frame into
+    - duplicates: every row whose brand appears more than once, with its unprocessed index
+    - preprocessed: the first row of every brand
+    """
+    sorted_df = df.sort_values(by="brand", kind="stable")
+    brands = sorted_df["brand"]
+    is_duplicate = brands.duplicated(keep=False) & brands.notna()
+    duplicates_df = pd.DataFrame({
+        "brand": brands[is_duplicate].to_numpy(),
+        "unprocessed_index": sorted_df.index[is_duplicate],
+        "asin": sorted_df["asin"][is_duplicate].to_numpy()
+    })
+    preprocessed_df = sorted_df[~brands.duplicated(keep="first")].reset_index(drop=True)
+    return duplicates_df, preprocessed_df
+
+
+def preprocess_bucket(key, csv_file):
+    """
+    Preprocess one prefix bucket and write its duplicates and preprocessed tables.
+    Returns a summary of the bucket, and its profile when profiling.
+    """
+    # detached: this can run in a worker process, preprocess_data attaches the span
+    with profiling.span("bucket", detached=True, bucket=key) as bucket_span:
+        df = storage.read_table(os.path.join(constants.DATA_DIRECTORY, csv_file))
+        raw_rows = len(df)
+        df_cleaned = df.dropna(subset=['brand'])
+        df['brand'] = preprocess_brands(df_cleaned['brand'])
+        duplicates_df, df = split_duplicates(df)
+        duplicate_file = constants.DUPLICATE_FILE(key)
+        storage.write_table(duplicates_df, duplicate_file)
+        preprocessed_file = constants.PREPROCESSED_FILE(key)
+        storage.write_table(df, preprocessed_file)
+        # clean_data keeps the counts up to date from here on
+        with profiling.timer("io"):
+            count_brands(duplicates_df).to_csv(constants.BRAND_COUNT_FILE(key), index=False)
+        bucket_span["rows_in"], bucket_span["rows_out"] = raw_rows, len(duplicates_df) + len(df)
+    return {
+        "bucket": key, "rows": raw_rows, "duplicate_rows": len(duplicates_df), "preprocessed_rows": len(df),
+        "profile": bucket_span if profiling.is_enabled() else None
+    }
 
-    duplicates_df = pd.DataFrame(duplicates)
-    return duplicates_df
 
+def get_preprocess_stage_files(key, csv_file):
+    inputs = [os.path.join(constants.DATA_DIRECTORY, csv_file)]
+    outputs = [constants.DUPLICATE_FILE(key), constants.PREPROCESSED_FILE(key), constants.BRAND_COUNT_FILE(key)]
+    return inputs, outputs
 
-def preprocess_data():
+
+@profiling.stage("preprocess_data")
+def preprocess_data(workers=1, force=False):
     # Remove na brands
     print("Preprocessing now...")
-    for key, csv_file in constants.BRAND_PREFIX_TO_FILE_NAME.items():
-        df = read_data(os.path.join(constants.DATA_DIRECTORY, csv_file))
-        df_cleaned = df.dropna(subset=['brand'])
-        df['brand'] = df_cleaned['brand'].apply(preprocess_brand)
-        duplicates_df = create_duplicate_csv(df)
-        duplicate_file = constants.DUPLICATE_FILE(key)
-        duplicates_df.to_csv(duplicate_file, index=False)
-        df = df.drop_duplicates(subset="brand", keep="first")
-        df = df.sort_values(by='brand')
-        df = df.reset_index(drop=True)
-        preprocessed_file = constants.PREPROCESSED_FILE(key)
-        df.to_csv(preprocessed_file, index=False)
+    run_manifest = manifest.load_manifest()
+    # skip buckets whose extract and outputs are unchanged since they were last preprocessed
+    buckets = [
+        (key, csv_file) for key, csv_file in constants.BRAND_PREFIX_TO_FILE_NAME.items()
+        if force or not manifest.is_up_to_date(run_manifest, "preprocess", key, *get_preprocess_stage_files(key, csv_file))
+    ]
+    print(f"{len(constants.BRAND_PREFIX_TO_FILE_NAME) - len(buckets)} buckets are up to date")
+    # largest buckets first so they don't end up as the tail of the pool
+    buckets = sorted(
+        buckets,
+        key=lambda item: storage.stored_size(os.path.join(constants.DATA_DIRECTORY, item[1])),
+        reverse=True
+    )
+    summaries = []
+    errors = {}
+    if workers > 1:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = {executor.submit(preprocess_bucket, key, csv_file): key for key, csv_file in buckets}
+            for future in as_completed(futures):
+                try:
+                    summaries.append(future.result())
+                except Exception as e:
+                    errors[futures[future]] = e
+    else:
+        for key, csv_file in buckets:
+            try:
+                summaries.append(preprocess_bucket(key, csv_file))
+            except Exception as e:
+                errors[key] = e
+
+    for summary in summaries:
+        key = summary["bucket"]
+        profiling.add_span(summary.pop("profile"))
+        manifest.record_stage(
+            run_manifest, "preprocess", key,
+            *get_preprocess_stage_files(key, constants.BRAND_PREFIX_TO_FILE_NAME[key])
+        )
+    manifest.save_manifest(run_manifest)
+
+    summaries = sorted(summaries, key=lambda summary: list(constants.BRAND_PREFIX_TO_FILE_NAME).index(summary["bucket"]))
+    stage_span = profiling.current_span()
+    stage_span["rows_in"] = sum(summary["rows"] for summary in summaries)
+    stage_span["rows_out"] = sum(summary["duplicate_rows"] + summary["preprocessed_rows"] for summary in summaries)
+    print(tabulate(summaries, headers="keys"))
     print(f"Dropping duplicates in preprocessed file")
-    print(f"Duplicate and preprocessed entries saved to {constants.DATA_DIRECTORY}.")
+    print(f"Duplicate and preprocessed entries saved to {constants.DEDUPLICATE_BRAND_DIR}.")
+    if errors:
+        for key, e in errors.items():
+            print(f"Error preprocessing bucket {key}: {e}")
+        raise Exception(f"Unable to preprocess buckets {sorted(errors)}")
 
 def preprocess_brand(brand):
     try:
@@ -65,14 +154,44 @@ def preprocess_brand(brand):
         raise Exception(f"Unable to preprocess {brand}: {e}")
     return brand
 
+# whitespace that str.split() splits on, restricted to ASCII
+ASCII_WHITESPACE = "\\t\\n\\x0b\\x0c\\r\\x1c-\\x1f "
+
+def preprocess_ascii_brands(brands):
+    # vectorized preprocess_brand over a list of ASCII strings: NFKD is a no-op there, so only the replacements are left
+    normalized = pc.ascii_upper(pa.array(brands, type=pa.string()))
+    normalized = pc.replace_substring(normalized, "-", "_hyphen_")
+    normalized = pc.replace_substring(normalized, "+", "_plus_")
+    normalized = pc.replace_substring_regex(normalized, "['\"]", "")
+    normalized = pc.replace_substring_regex(normalized, f"[{ASCII_WHITESPACE}]+", " ")
+    normalized = pc.replace_substring_regex(normalized, "^ | $", "")
+    return normalized.to_pylist()
+
+def preprocess_brands(brands):
+    """
+    Batch version of preprocess_brand for a whole Series, with the same output.
+    Each distinct raw string is normalized once. ASCII strings skip the Unicode decomposition
+    and go through vectorized string ops, the rest through preprocess_brand.
+    """
+    # dict.fromkeys rather than Series.unique, which conflates strings that only differ after a NUL
+    unique_brands = dict.fromkeys(brands.dropna().tolist())
+    ascii_brands, other_brands = [], []
+    for brand in unique_brands:
+        if not isinstance(brand, str):
+            raise Exception(f"Unable to preprocess {brand}: not a string")
+        (ascii_brands if brand.isascii() else other_brands).append(brand)
+
+    normalized_brands = dict(zip(ascii_brands, preprocess_ascii_brands(ascii_brands)))
+    normalized_brands.update((brand, preprocess_brand(brand)) for brand in other_brands)
+    return brands.map(normalized_brands)
+
+@profiling.stage("get_brand_id_map")
 def get_brand_id_map(df_name):
-    if df_name == "iri":
-        source_dataset = read_data(os.path.join(constants.MAPPINGS_DIRECTORY, "Nov 2024 BV product_brand_id sales - iri.csv"))
-    elif df_name == "gs1":
-        source_dataset = read_data(os.path.join(constants.MAPPINGS_DIRECTORY, "Nov 2024 BV product_brand_id sales - gs1.csv"))
+    if df_name in ("iri", "gs1"):
+        source_dataset = read_data(constants.get_source_brands_file(df_name))
 
     print("Creating brand_id to brand string map")
-    ranked_df = read_data(os.path.join(constants.MAPPINGS_DIRECTORY, "Nov 2024 BV product_brand_id sales - sales rank.csv"))
+    ranked_df = read_data(constants.SALES_RANK_CSV)
 
     # Merge the DataFrames on product_brand_id to match rows directly
     merged_df = pd.merge(
@@ -83,286 +202,537 @@ def get_brand_id_map(df_name):
         how='inner'
     )
 
-    # Group by (product_symbol_id, product_brand_id) and aggregate brand strings into lists
-    merged_df['brand'] = merged_df['brand'].astype(str).apply(preprocess_brand)
-    brand_id_to_list_of_brand_strings = (
-        merged_df.groupby(['product_symbol_id', 'product_brand_id'])['brand']
-        .apply(lambda x: sorted(x.tolist()))
-        .to_dict()
-    )
-
-    brand_id_to_list_of_brand_strings_str = {
-        f"{int(key[0]) if pd.notna(key[0]) else 'None'},{int(key[1]) if pd.notna(key[1]) else 'None'}": value
-        for key, value in brand_id_to_list_of_brand_strings.items()
-    }
-    file_path = constants.get_brand_clusters_file(df_name)
-    with open(file_path, "w") as json_file:
-        json.dump(brand_id_to_list_of_brand_strings_str, json_file, indent=4)
+    # One cluster per (product_symbol_id, product_brand_id) with its sorted brand strings
+    merged_df['brand'] = preprocess_brands(merged_df['brand'].astype(str))
+    brand_clusters = clusters.ClusterStore.from_frame(merged_df, "product_symbol_id", "product_brand_id", "brand")
+    profiling.current_span()["rows_in"] = len(source_dataset)
+    profiling.current_span()["rows_out"] = len(brand_clusters)
+    brand_clusters.write(constants.get_brand_cluster_store_file(df_name))
+    file_path = brand_clusters.write_json(constants.get_brand_clusters_file(df_name))
     print(f"clusters saved to {file_path}")
 
-def get_preprocessed_data(preprocessed_data_cache, first_character):
-    # if file not in cache, open the file
-    if first_character not in preprocessed_data_cache:
-        if first_character.isalpha() and first_character.isupper():
-            preprocessed_file = constants.PREPROCESSED_FILE(first_character)
-        else:
-            preprocessed_file = constants.PREPROCESSED_FILE(constants.MISC_NAME)
-        preprocessed_data_cache[first_character] = read_data(preprocessed_file)
-    return preprocessed_data_cache[first_character]
-
-def get_duplicate_data(duplicate_data_cache, first_character):
-    # if file not in cache, open the file
-    if first_character not in duplicate_data_cache:
-        if first_character.isalpha() and first_character.isupper():
-            duplicate_file = constants.DUPLICATE_FILE(first_character)
-        else:
-            duplicate_file = constants.DUPLICATE_FILE(constants.MISC_NAME)
-        duplicate_data_cache[first_character] = read_data(duplicate_file)
-    return duplicate_data_cache[first_character]
-
-def get_original_data(original_data_cache, first_character):
-    if first_character not in original_data_cache:
-        if first_character.isalpha() and first_character.isupper():
-            original_file = constants.BRAND_PREFIX_TO_FILE_NAME[first_character]
-        else:
-            original_file = constants.BRAND_PREFIX_TO_FILE_NAME[constants.MISC_NAME]
-        csv_file = os.path.join(constants.DATA_DIRECTORY, original_file)
-        original_data_cache[first_character] = read_data(csv_file)
-    return original_data_cache[first_character]
+def get_prefix_key(first_character):
+    # brands that don't start with an uppercase letter live in the misc bucket
+    if first_character.isalpha() and first_character.isupper():
+        return first_character
+    return constants.MISC_NAME
+
+def get_asins(preprocessed_df):
+    # ASINs as Python objects, None where there is none (the extraction LEFT JOINs the product codes)
+    return preprocessed_df["asin"].to_numpy(dtype=object, na_value=None)
+
+def get_preprocessed_data(store, first_character):
+    # each bucket file is only read once per store
+    preprocessed_file = constants.PREPROCESSED_FILE(get_prefix_key(first_character))
+    profiling.count_cache("preprocessed_data_cache", preprocessed_file in store)
+    return store.get(preprocessed_file)
+
+def get_exact_index(exact_index_cache, preprocessed_df, prefix):
+    # brand -> row index of the bucket's preprocessed frame, built once per bucket
+    if prefix not in exact_index_cache:
+        exact_index_cache[prefix] = matching.build_exact_index(preprocessed_df['brand'].tolist())
+    return exact_index_cache[prefix]
+
+def get_duplicate_data(store, first_character):
+    duplicate_file = constants.DUPLICATE_FILE(get_prefix_key(first_character))
+    profiling.count_cache("duplicate_data_cache", duplicate_file in store)
+    return store.get(duplicate_file)
+
+def get_original_data(store, first_character):
+    original_file = constants.BRAND_PREFIX_TO_FILE_NAME[get_prefix_key(first_character)]
+    csv_file = os.path.join(constants.DATA_DIRECTORY, original_file)
+    profiling.count_cache("original_data_cache", csv_file in store)
+    return store.get(csv_file, read=lambda path: storage.read_table(path, columns=["brand", "asin"]))
+
+def open_match_cache():
+    # results of earlier runs, None when MATCH_CACHE_DB turns the cache off
+    return match_cache.MatchCache() if constants.MATCH_CACHE_DB else None
+
+def match_bucket_cached(result_cache, prefix, preprocessed_df, queries):
+    """
+    Asin of the best match within EXACT_MATCH_CUTOFF of every query, None where there is none.
+    Only the queries that weren't scored against the same bucket content on an earlier run are scored
+    """
+    cache_key = (prefix, match_cache.table_hash([preprocessed_df]), "JaroWinkler.distance", constants.EXACT_MATCH_CUTOFF, 1)
+    cached = result_cache.get(*cache_key, queries) if result_cache is not None else {}
+    new_queries = list(dict.fromkeys(query for query in queries if query not in cached))
+    extracted_indices = matching.match_bucket(
+        new_queries,
+        preprocessed_df['brand'].tolist(),
+        scorer=distance.JaroWinkler.distance,
+        score_cutoff=constants.EXACT_MATCH_CUTOFF
+    )
+    asins = get_asins(preprocessed_df)
+    new_results = {
+        query: asins[extracted_index] if extracted_index >= 0 else None
+        for query, extracted_index in zip(new_queries, extracted_indices)
+    }
+    if result_cache is not None:
+        result_cache.put(*cache_key, new_results)
+    results = {**cached, **new_results}
+    return [results[query] for query in queries]
 
-def read_cluster_json(df_name):
+def read_clusters(df_name):
     print("Reading brand_id to brand string map")
-    file_path = constants.get_brand_clusters_file(df_name)
-    with open(file_path, "r") as json_file:
-        brand_id_to_list_of_brand_strings = json.load(json_file)
-    return brand_id_to_list_of_brand_strings
+    store_file = constants.get_brand_cluster_store_file(df_name)
+    if os.path.exists(store_file):
+        return clusters.ClusterStore.read(store_file)
+    # clusters created before there was a store
+    with open(constants.get_brand_clusters_file(df_name), "r") as json_file:
+        return clusters.ClusterStore.from_json_map(json.load(json_file))
 
 def load_manual_clusters():
     """Load manually defined brand clusters from JSON."""
     if os.path.exists(constants.MANUAL_CLUSTERS_JSON):
         with open(constants.MANUAL_CLUSTERS_JSON, "r") as file:
-            return json.load(file)
-    return {}
-
-def merge_json_maps(primary_map, secondary_map):
-    """
-    Merges two JSON dictionaries.
-    - If a key exists in both, it appends values from secondary_map to primary_map.
-    - If a key exists only in secondary_map, it is added to primary_map.
-    """
-    merged_map = primary_map.copy()  # Start with the primary map
+            return clusters.ClusterStore.from_json_map(json.load(file))
+    return clusters.ClusterStore.from_json_map({})
 
-    for key, values in secondary_map.items():
-        if key in merged_map:
-            merged_map[key] = sorted(merged_map[key] + values)
-        else:
-            merged_map[key] = values
-    return merged_map
-
-def match_brand_str_to_brand_id(df_name):
+@profiling.stage("match_brand_str_to_brand_id")
+def match_brand_str_to_brand_id(df_name, store=None, write_output=True):
     # Assumes that clusters are already built
     # Get symbol_id, brand_id to [brand_strings] map
     # For every brand_string, look for an exact match in their corresponding {prefix}_preprocessed_data.csv
-    mapped_brand_string_to_brand_id = []
-    preprocessed_data_cache = {}
+    # Returns the mapped brands, which are also saved to brands_that_match.csv unless write_output is False
+    preprocessed_data_cache = store if store is not None else storage.BucketStore()
+    exact_index_cache = {}
+    # the hash index is cheaper than a cache lookup, only fuzzy matches are cached
+    result_cache = open_match_cache() if constants.EXACT_MATCH_CUTOFF > 0 else None
     # combine manual mapping and data source mapping
-    manual_map = load_manual_clusters()
-    brand_id_to_brand_strings_map = merge_json_maps(read_cluster_json(df_name), manual_map)
-    # find the exact match to brand_string
-    for key, list_of_brand_strings in brand_id_to_brand_strings_map.items():
-        symbol_id, brand_id = key.split(",")
-        for brand_string in list_of_brand_strings:
-            first_character = brand_string[0]
+    brand_clusters = read_clusters(df_name).merge(load_manual_clusters())
+    brand_strings, brand_ids, symbol_ids = brand_clusters.flatten()
+
+    # find the exact match to brand_string through the bucket's hash index.
+    # Only scan the bucket when a fuzzy tolerance is configured
+    matched_asins = {}
+    for prefix, positions in matching.group_by_prefix(brand_strings, get_prefix_key).items():
+        with profiling.span("bucket", bucket=prefix) as bucket_span:
+            first_character = brand_strings[positions[0]][0]
             preprocessed_df = get_preprocessed_data(preprocessed_data_cache, first_character)
-            result = extractOne(
-                brand_string,
-                preprocessed_df['brand'].tolist(),
-                scorer=distance.JaroWinkler.distance,
-                score_cutoff=0.0
-            )
-
-            if result:
-                extracted_string, calculated_distance, extracted_index = result
-                product_asin = preprocessed_df.iloc[extracted_index]["asin"]
-                mapped_brand_string_to_brand_id.append(
-                    (
-                        brand_string,
-                        brand_id,
-                        symbol_id,
-                        product_asin,
-                    ))
+            queries = [brand_strings[position] for position in positions]
+            with profiling.timer("match"):
+                if constants.EXACT_MATCH_CUTOFF > 0:
+                    bucket_asins = match_bucket_cached(result_cache, prefix, preprocessed_df, queries)
+                else:
+                    exact_index = get_exact_index(exact_index_cache, preprocessed_df, prefix)
+                    extracted_indices = matching.match_exact(queries, exact_index)
+                    asins = get_asins(preprocessed_df)
+                    bucket_asins = [asins[index] if index >= 0 else None for index in extracted_indices]
+            for position, asin in zip(positions, bucket_asins):
+                if asin is not None:
+                    matched_asins[position] = asin
+            bucket_span["rows_in"], bucket_span["rows_out"] = len(queries), sum(asin is not None for asin in bucket_asins)
+    if result_cache is not None:
+        result_cache.close()
+
+    mapped_brand_string_to_brand_id = [
+        (brand_strings[position], brand_ids[position], symbol_ids[position], matched_asins[position])
+        for position in range(len(brand_strings))
+        if position in matched_asins
+    ]
 
     output_df = pd.DataFrame(
         mapped_brand_string_to_brand_id,
         columns=["brand_string", "brand_id", "symbol_id", "asin"]
     )
+    # ids as read back from brands_that_match.csv, numeric with "None" as NaN
+    output_df["brand_id"] = pd.to_numeric(output_df["brand_id"], errors="coerce")
+    output_df["symbol_id"] = pd.to_numeric(output_df["symbol_id"], errors="coerce")
 
     print(f"skip {output_df[output_df['brand_string'] == 'NOBRAND'].shape[0]} entries with NOBRAND for now")
-    output_df = output_df[output_df["brand_string"] != "NOBRAND"]
-    output_df.to_csv(constants.BRANDS_THAT_MATCH_CSV, index=False)
+    output_df = output_df[output_df["brand_string"] != "NOBRAND"].reset_index(drop=True)
+    profiling.current_span()["rows_in"], profiling.current_span()["rows_out"] = len(brand_strings), len(output_df)
+    if write_output:
+        write_brands_that_match(output_df)
+    return output_df
+
+def write_brands_that_match(mapped_df):
+    storage.write_csv(mapped_df, constants.BRANDS_THAT_MATCH_CSV)
     print(f"Mapped brand data saved to {constants.BRANDS_THAT_MATCH_CSV}")
 
-def find_original_brand_strings(original_df, asin):
+def group_values_by_key(keys, values):
     """
-    brand string has been preprocessed
-    get the original brand string before the preprocessing
-    returns a list because there may be more than 1 brand string associated to an asin
+    Map every non-null key to the list of values on its rows, in file order.
+    Lookups give the same rows as filtering with values[keys == key]
     """
-    return original_df[original_df['asin'] == asin]['brand'].tolist()
+    # factorize is fast on Arrow strings too, where groupby indices isn't. Missing keys get code -1
+    codes, uniques = pd.factorize(keys)
+    order = np.argsort(codes, kind="stable")
+    boundaries = np.searchsorted(codes[order], np.arange(len(uniques) + 1))
+    values = values.to_numpy()[order]
+    return {
+        key: values[boundaries[code]:boundaries[code + 1]].tolist()
+        for code, key in enumerate(uniques.tolist())
+    }
 
 
-def get_all_matches():
+@profiling.stage("get_all_matches")
+def get_all_matches(mapped_df=None, store=None):
     """"
-    Get brand_string matches from brands_that_match
+    Get brand_string matches from brands_that_match (or the mapped_df it was written from)
     Go through duplicates.csv to get all duplicate brand_strings
     """
-    mapped_df = read_data(constants.BRANDS_THAT_MATCH_CSV)
-    output_rows = []
-    duplicate_cached_data = {}
-    original_data_cache = {}
+    if mapped_df is None:
+        mapped_df = read_data(constants.BRANDS_THAT_MATCH_CSV)
+    output_dfs = []
+    store = store if store is not None else storage.BucketStore()
     # Group by first character for batch processing
     grouped_mapped = mapped_df.groupby(mapped_df["brand_string"].str[0])
     for first_character, group in grouped_mapped:
-        duplicate_df = get_duplicate_data(duplicate_cached_data, first_character)
-        # Get original brand string, before preprocessing
-        original_df = get_original_data(original_data_cache, first_character)
-        for _, row in group.iterrows():
-            brand_string = row["brand_string"]
-            # Filter duplicate_df for matches with the current brand_string
-            filtered_df = duplicate_df[duplicate_df["brand"] == brand_string]
-            if filtered_df.empty:
-                # No matches in duplicates, so save all entries of single ASIN
-                # Unfortunately, there can be multiple brand strings per ASIN
-                list_of_original_brand_strings_per_asin = find_original_brand_strings(original_df, row['asin'])
-                output_rows.extend(
-                    {
-                        "brand_string": original_brand_string,
-                        "brand_id": row["brand_id"],
-                        "symbol_id": row["symbol_id"],
-                        "asin": row["asin"]
-                    }
-                    for original_brand_string in list_of_original_brand_strings_per_asin
-                )
-                continue
-
-            all_new_rows = []
-            for _, filtered_row in filtered_df.iterrows():
-                # Get all original brand strings for the matched ASIN
-                list_of_original_brand_strings_per_asin = find_original_brand_strings(original_df, filtered_row['asin'])
-                new_rows = [
-                    {
-                        "brand_string": original_brand_string,
-                        "brand_id": row["brand_id"],
-                        "symbol_id": row["symbol_id"],
-                        "asin": filtered_row["asin"]
-                    }
-                    for original_brand_string in list_of_original_brand_strings_per_asin
-                ]
-                if new_rows:
-                    all_new_rows.extend(new_rows)
-                else:
-                    print(f"Warning: No brand strings found for ASIN {filtered_row['asin']}")
-            output_rows.extend(all_new_rows)
-    return pd.DataFrame(output_rows)
-
-
+        with profiling.span("bucket", bucket=get_prefix_key(first_character), first_character=first_character) as bucket_span:
+            duplicate_df = get_duplicate_data(store, first_character)
+            # Get original brand string, before preprocessing
+            original_df = get_original_data(store, first_character)
+            # Index both files once instead of scanning them for every mapped row.
+            # Original rows are collected by position and taken from the columns at the end,
+            # so the output strings stay in their compact column representation
+            duplicate_asins_by_brand = group_values_by_key(duplicate_df["brand"], duplicate_df["asin"])
+            original_rows_by_asin = group_values_by_key(original_df["asin"], pd.Series(np.arange(len(original_df))))
+            mapped_rows, original_rows = [], []
+            for mapped_row, (brand_string, asin) in enumerate(zip(group["brand_string"], group["asin"])):
+                duplicate_asins = duplicate_asins_by_brand.get(brand_string)
+                if not duplicate_asins:
+                    # No matches in duplicates, so save all entries of single ASIN
+                    # Unfortunately, there can be multiple brand strings per ASIN
+                    rows = original_rows_by_asin.get(asin, [])
+                    original_rows.extend(rows)
+                    mapped_rows.extend([mapped_row] * len(rows))
+                    continue
+
+                for duplicate_asin in duplicate_asins:
+                    # Get all original brand strings for the matched ASIN
+                    rows = original_rows_by_asin.get(duplicate_asin)
+                    if not rows:
+                        print(f"Warning: No brand strings found for ASIN {duplicate_asin}")
+                        continue
+                    original_rows.extend(rows)
+                    mapped_rows.extend([mapped_row] * len(rows))
+            output_dfs.append(pd.DataFrame({
+                "brand_string": original_df["brand"].take(original_rows).reset_index(drop=True),
+                "brand_id": group["brand_id"].take(mapped_rows).reset_index(drop=True),
+                "symbol_id": group["symbol_id"].take(mapped_rows).reset_index(drop=True),
+                # the ASIN the brand string was found under
+                "asin": original_df["asin"].take(original_rows).reset_index(drop=True),
+            }))
+            bucket_span["rows_in"], bucket_span["rows_out"] = len(group), len(original_rows)
+    output_df = pd.concat(output_dfs, ignore_index=True) if output_dfs else pd.DataFrame(
+        columns=["brand_string", "brand_id", "symbol_id", "asin"])
+    # the bucket tables were copied into output_df
+    del output_dfs
+    storage.release_unused_memory()
+    profiling.current_span()["rows_in"], profiling.current_span()["rows_out"] = len(mapped_df), len(output_df)
+    return output_df
+
+
+@profiling.stage("write_mapped_brands")
 def write_mapped_brands(final_mapped_df):
     final_mapped_df = pd.concat(final_mapped_df, ignore_index=True)
     final_mapped_df = final_mapped_df.sort_values(by="symbol_id")
-    final_mapped_df.to_csv(constants.DELIVERABLE_MAPPED_BRANDS_CSV, index=False)
+    profiling.current_span()["rows_out"] = len(final_mapped_df)
+    storage.write_csv(final_mapped_df, constants.DELIVERABLE_MAPPED_BRANDS_CSV)
     print(f"{final_mapped_df.shape[0]} entries mapped. All mapped entries saved to {constants.DELIVERABLE_MAPPED_BRANDS_CSV}")
 
 
-def clean_data():
-    # mapped_brands_with_indices will be stale
-    print(f"Cleaning duplicate and preprocessed data. {constants.BRANDS_THAT_MATCH_CSV} will be stale")
-    mapped_df = read_data(constants.BRANDS_THAT_MATCH_CSV)
-    for key, csv_file in constants.BRAND_PREFIX_TO_FILE_NAME.items():
-        duplicate_file = constants.DUPLICATE_FILE(key)
-        duplicate_df = read_data(duplicate_file)
-        # get all brands in duplicates that have the same NAME (these will have different ASIN)
-        if key == constants.MISC_NAME:
-            brands_to_drop = mapped_df[mapped_df["brand_string"].str.match(r'^\d', na=False)]['brand_string'].tolist()
-        else:
-            brands_to_drop = mapped_df[mapped_df["brand_string"].str.startswith(key, na=False)]["brand_string"].tolist()
-
-        dropped_brands_duplicate_df = duplicate_df[~duplicate_df["brand"].isin(brands_to_drop)]
-        dropped_brands_duplicate_df.to_csv(duplicate_file, index=False)
-
-        preprocessed_file = constants.PREPROCESSED_FILE(key)
-        preprocessed_df = read_data(preprocessed_file)
-        # Find all the singular entries (no duplicates) and delete using by using their asin
-        if key == constants.MISC_NAME:
-            asins_to_drop = mapped_df[mapped_df["brand_string"].str.match(r'^\d', na=False)]['asin'].tolist()
-        else:
-            asins_to_drop = mapped_df[mapped_df["brand_string"].str.startswith(key, na=False)]['asin'].tolist()
-        dropped_asins_preprocessed_df = preprocessed_df[~preprocessed_df['asin'].isin(asins_to_drop)]
-        dropped_asins_preprocessed_df.to_csv(preprocessed_file, index=False)
+def get_clean_keys(brand_strings):
+    """
+    The bucket each mapped brand string is cleaned from: the letter it starts with,
+    misc if it starts with a digit, and NaN otherwise
+    """
+    first_characters = brand_strings.str[:1]
+    clean_keys = first_characters.where(first_characters.isin(list("ABCDEFGHIJKLMNOPQRSTUVWXYZ")))
+    return clean_keys.mask(brand_strings.str.match(r'^\d', na=False), constants.MISC_NAME)
+
+
+def count_brands(duplicate_df):
+    # number of duplicate rows per brand, most duplicated first (brand order on ties)
+    return (
+        duplicate_df.groupby("brand")
+        .size()
+        .reset_index(name="count")
+        .sort_values(by="count", ascending=False, kind="stable")
+    )
 
 
+@profiling.stage("clean_data")
+def clean_data(mapped_df=None, store=None):
+    """
+    Drop the mapped brands from the duplicate and preprocessed buckets and their brand counts.
+    With a store, the cleaned tables are only kept in it until the caller persists them.
+    """
+    # mapped_brands_with_indices will be stale
+    print(f"Cleaning duplicate and preprocessed data. {constants.BRANDS_THAT_MATCH_CSV} will be stale")
+    if mapped_df is None:
+        mapped_df = read_data(constants.BRANDS_THAT_MATCH_CSV)
+    persist = store is None
+    store = store if store is not None else storage.BucketStore()
+    profiling.current_span()["rows_in"] = len(mapped_df)
+    # partition the mapped brands by bucket once. The columns are kept as they are for isin,
+    # which doesn't turn Arrow strings into Python objects like a set would
+    entries_to_drop = {
+        key: (group["brand_string"], group["asin"])
+        for key, group in mapped_df.groupby(get_clean_keys(mapped_df["brand_string"]))
+    }
+    rewritten_buckets = []
+    for key in constants.BRAND_PREFIX_TO_FILE_NAME:
+        if key not in entries_to_drop:
+            continue
+        with profiling.span("bucket", bucket=key) as bucket_span:
+            brands_to_drop, asins_to_drop = entries_to_drop[key]
+            duplicate_file = constants.DUPLICATE_FILE(key)
+            duplicate_df = store.get(duplicate_file)
+            # get all brands in duplicates that have the same NAME (these will have different ASIN)
+            kept_duplicates = ~duplicate_df["brand"].isin(brands_to_drop)
+            if not kept_duplicates.all():
+                store.put(duplicate_file, duplicate_df[kept_duplicates].reset_index(drop=True))
+                # dropped brands lose all of their rows, so the other brands' counts are unchanged
+                count_file = constants.BRAND_COUNT_FILE(key)
+                if count_file in store or os.path.exists(count_file):
+                    brand_count_df = store.get(count_file, read=read_data)
+                    brand_count_df = brand_count_df[~brand_count_df["brand"].isin(brands_to_drop)]
+                else:
+                    brand_count_df = count_brands(duplicate_df[kept_duplicates])
+                store.put(count_file, brand_count_df, write=lambda df, path: df.to_csv(path, index=False))
+
+            preprocessed_file = constants.PREPROCESSED_FILE(key)
+            preprocessed_df = store.get(preprocessed_file)
+            # Find all the singular entries (no duplicates) and delete using by using their asin
+            kept_preprocessed = ~preprocessed_df['asin'].isin(asins_to_drop)
+            if not kept_preprocessed.all():
+                store.put(preprocessed_file, preprocessed_df[kept_preprocessed].reset_index(drop=True))
+
+            if not (kept_duplicates.all() and kept_preprocessed.all()):
+                rewritten_buckets.append(key)
+            bucket_span["rows_in"] = len(duplicate_df) + len(preprocessed_df)
+            bucket_span["rows_out"] = int(kept_duplicates.sum() + kept_preprocessed.sum())
+    if persist:
+        store.persist()
+    print(f"Rewrote {len(rewritten_buckets)} buckets: {', '.join(rewritten_buckets)}")
+
+
+@profiling.stage("count_duplicates")
 def count_duplicates():
     print("Counting brands...")
     for key, csv_file in constants.BRAND_PREFIX_TO_FILE_NAME.items():
-        duplicate_file = constants.DUPLICATE_FILE(key)
-        duplicate_df = read_data(duplicate_file)
-        result = (
-            duplicate_df.groupby("brand")
-            .size()
-            .reset_index(name="count")
-            .sort_values(by="count", ascending=False)
-        )
-
-        output_file = f"{key}_brand_count_index.csv"
-        result.to_csv(os.path.join(constants.DEDUPLICATE_BRAND_DIR, output_file), index=False)
+        with profiling.span("bucket", bucket=key) as bucket_span:
+            duplicate_file = constants.DUPLICATE_FILE(key)
+            duplicate_df = storage.read_table(duplicate_file, columns=["brand"])
+            brand_count_df = count_brands(duplicate_df)
+            with profiling.timer("io"):
+                brand_count_df.to_csv(constants.BRAND_COUNT_FILE(key), index=False)
+            bucket_span["rows_in"], bucket_span["rows_out"] = len(duplicate_df), len(brand_count_df)
     print(f"Saved brand counts to brand_count_index.csv")
 
 
-def find_nearest_match(df_name):
+def get_blocking_index(blocking_index_cache, preprocessed_data_cache, prefix):
+    # candidate blocking index over a preprocessed file and the asin of each of its rows, built once per file
+    if prefix not in blocking_index_cache:
+        preprocessed_df = get_preprocessed_data(preprocessed_data_cache, prefix)
+        blocking_index_cache[prefix] = (
+            matching.BlockingIndex(preprocessed_df['brand'].tolist()),
+            get_asins(preprocessed_df)
+        )
+    return blocking_index_cache[prefix]
+
+def search_blocking(brand_strings, preprocessed_data_cache, search_all_buckets):
+    """
+    Yield (position, nearest matches) for every brand string, the matches as (brand, distance, asin)
+    tuples, best first. Scores every brand of the searched buckets that the blocking index can't rule out
+    """
+    blocking_index_cache = {}
+    # queries search the buckets in turn, so bucket times are added up over all of them
+    bucket_totals = profiling.SpanTotals("bucket", "bucket")
+    for position, iri_brand_string in enumerate(brand_strings):
+        prefix = get_prefix_key(iri_brand_string[0])
+        searched_prefixes = [prefix]
+        if search_all_buckets:
+            searched_prefixes += [other for other in constants.BRAND_PREFIX_TO_FILE_NAME if other != prefix]
+        result = []
+        for searched_prefix in searched_prefixes:
+            with bucket_totals.timer(searched_prefix):
+                with profiling.timer("match"):
+                    blocking_index, asins = get_blocking_index(blocking_index_cache, preprocessed_data_cache, searched_prefix)
+                    # only score the rows that can be within the cutoff
+                    candidates = blocking_index.candidates(iri_brand_string, constants.NEAREST_MATCH_CUTOFF)
+                    for extracted_string, jarowinkler_distance, candidate_index in extract(
+                        iri_brand_string,
+                        blocking_index.choices[candidates].tolist(),
+                        scorer=distance.JaroWinkler.distance,
+                        score_cutoff=constants.NEAREST_MATCH_CUTOFF,
+                        limit=constants.NEAREST_MATCH_LIMIT
+                    ):
+                        result.append((extracted_string, jarowinkler_distance, asins[candidates[candidate_index]]))
+        # own bucket first on ties
+        yield position, sorted(result, key=lambda tup: tup[1])[:constants.NEAREST_MATCH_LIMIT]
+    bucket_totals.attach()
+
+def get_ngram_index(ngram_index_cache, preprocessed_data_cache, prefixes):
+    # n-gram index over the preprocessed files of prefixes and the asin of each of its rows, built once
+    if prefixes not in ngram_index_cache:
+        preprocessed_dfs = [get_preprocessed_data(preprocessed_data_cache, prefix) for prefix in prefixes]
+        preprocessed_df = pd.concat(preprocessed_dfs, ignore_index=True)
+        ngram_index_cache[prefixes] = (
+            matching.NgramIndex(preprocessed_df["brand"].tolist()),
+            get_asins(preprocessed_df)
+        )
+    return ngram_index_cache[prefixes]
+
+def search_ngrams(brand_strings, preprocessed_data_cache, search_all_buckets):
+    """
+    Yield (position, nearest matches) for every brand string like search_blocking, re-scoring the brands
+    with the most similar character n-grams in their bucket, or in one index over all buckets
+    """
+    ngram_index_cache = {}
+    if search_all_buckets:
+        positions_by_index = {tuple(constants.BRAND_PREFIX_TO_FILE_NAME): range(len(brand_strings))}
+    else:
+        positions_by_index = {
+            (prefix,): positions
+            for prefix, positions in matching.group_by_prefix(brand_strings, get_prefix_key).items()
+        }
+    for prefixes, positions in positions_by_index.items():
+        with profiling.span("bucket", bucket=",".join(prefixes)) as bucket_span:
+            ngram_index, asins = get_ngram_index(ngram_index_cache, preprocessed_data_cache, prefixes)
+            with profiling.timer("match"):
+                matches = list(ngram_index.search(
+                    [brand_strings[position] for position in positions],
+                    scorer=distance.JaroWinkler.distance,
+                    score_cutoff=constants.NEAREST_MATCH_CUTOFF,
+                    limit=constants.NEAREST_MATCH_LIMIT,
+                    candidates=constants.NEAREST_MATCH_NGRAM_CANDIDATES
+                ))
+            bucket_span["rows_in"], bucket_span["rows_out"] = len(positions), sum(map(len, matches))
+        for position, result in zip(positions, matches):
+            yield position, [(extracted_string, jarowinkler_distance, asins[row])
+                             for extracted_string, jarowinkler_distance, row in result]
+
+def search_cdist(brand_strings, preprocessed_data_cache, search_all_buckets):
+    """
+    Yield (position, nearest matches) for every brand string like search_blocking, scoring chunks of
+    NEAREST_MATCH_QUERY_CHUNK brand strings against the whole bucket on all cores
+    """
+    # queries are scored bucket by bucket, so bucket times are added up over all of their chunks
+    bucket_totals = profiling.SpanTotals("bucket", "bucket")
+    positions_by_prefix = matching.group_by_prefix(brand_strings, get_prefix_key)
+    # with search_all_buckets, the matches of every brand string are kept until all buckets are searched
+    best_matches = {}
+    for prefix in constants.BRAND_PREFIX_TO_FILE_NAME:
+        positions = range(len(brand_strings)) if search_all_buckets else positions_by_prefix.get(prefix, [])
+        if not positions:
+            continue
+        preprocessed_df = get_preprocessed_data(preprocessed_data_cache, prefix)
+        has_brand = preprocessed_df["brand"].map(lambda brand: isinstance(brand, str))
+        choices = preprocessed_df["brand"][has_brand].tolist()
+        asins = get_asins(preprocessed_df[has_brand])
+        for start in range(0, len(positions), constants.NEAREST_MATCH_QUERY_CHUNK):
+            chunk = positions[start:start + constants.NEAREST_MATCH_QUERY_CHUNK]
+            with bucket_totals.timer(prefix, rows=len(chunk)), profiling.timer("match"):
+                chunk_matches = matching.top_k_bucket(
+                    [brand_strings[position] for position in chunk],
+                    choices,
+                    scorer=distance.JaroWinkler.distance,
+                    score_cutoff=constants.NEAREST_MATCH_CUTOFF,
+                    limit=constants.NEAREST_MATCH_LIMIT
+                )
+            for position, matches in zip(chunk, chunk_matches):
+                result = [(choices[index], jarowinkler_distance, asins[index]) for index, jarowinkler_distance in matches]
+                if not search_all_buckets:
+                    yield position, result
+                    continue
+                # own bucket first on ties, then bucket order
+                own_bucket = get_prefix_key(brand_strings[position][0]) == prefix
+                merged = best_matches.get(position, []) + [(not own_bucket, match) for match in result]
+                best_matches[position] = sorted(merged, key=lambda item: (item[1][1], item[0]))[:constants.NEAREST_MATCH_LIMIT]
+    for position, matches in best_matches.items():
+        yield position, [match for _, match in matches]
+    bucket_totals.attach()
+
+def engine_key(engine):
+    # the engine and the settings its results depend on besides the cutoff and limit
+    if engine == "tfidf":
+        return f"{engine}:{constants.NEAREST_MATCH_NGRAM_CANDIDATES}"
+    return engine
+
+@profiling.stage("find_nearest_match")
+def find_nearest_match(df_name, search_all_buckets=constants.NEAREST_MATCH_SEARCH_ALL_BUCKETS,
+                       engine=constants.NEAREST_MATCH_ENGINE):
     # Get symbol_id, brand_id to [brand_strings] map
     # For every brand_string, look for the top 10 closest match within a 0.15 distance
     # in their corresponding {prefix}_preprocessed_data.csv
-    mapped_brand_string_to_brand_id = []
-    preprocessed_data_cache = {}
-    print("Getting nearest matches")
+    # (or in every bucket with search_all_buckets, to catch typos in the first character)
+    preprocessed_data_cache = storage.BucketStore()
+    print(f"Getting nearest matches ({engine})")
     # combine manual mapping and data source mapping
-    manual_map = load_manual_clusters()
-    brand_id_to_brand_strings_map = merge_json_maps(read_cluster_json(df_name), manual_map)
-    for key, list_of_brand_strings in brand_id_to_brand_strings_map.items():
-        symbol_id, brand_id = key.split(",")
-        for iri_brand_string in list_of_brand_strings:
-            first_character = iri_brand_string[0]
-            preprocessed_df = get_preprocessed_data(preprocessed_data_cache, first_character)
-            result = extract(
-                iri_brand_string,
-                preprocessed_df['brand'].tolist(),
-                scorer=distance.JaroWinkler.distance,
-                score_cutoff=0.15,
-                limit=10
-            )
-            if result:
-                for tup in result:
-                    extracted_string, jarowinkler_distance, extracted_index = tup
-                    mapped_brand_string_to_brand_id.append(
-                        (
-                            iri_brand_string,
-                            extracted_string,
-                            jarowinkler_distance,
-                            brand_id,
-                            symbol_id,
-                            preprocessed_df.iloc[extracted_index]["asin"],
-                        )
-                    )
-
-
-    output_df = pd.DataFrame(
-        mapped_brand_string_to_brand_id,
-        columns=["iri_brand_string", "found_brand_string", "jarowinkler_distance", "brand_id", "symbol_id", "asin"]
+    brand_clusters = read_clusters(df_name).merge(load_manual_clusters())
+    brand_strings, brand_ids, symbol_ids = brand_clusters.flatten()
+
+    if engine not in ("blocking", "cdist", "tfidf"):
+        raise Exception(f"Unknown nearest match engine {engine}")
+    search = {"blocking": search_blocking, "cdist": search_cdist, "tfidf": search_ngrams}[engine]
+
+    # brand strings searched on an earlier run against buckets that haven't changed since aren't searched again.
+    # A search over all buckets depends on all of them
+    result_cache = open_match_cache()
+    if search_all_buckets:
+        positions_by_bucket = {"*": list(range(len(brand_strings)))}
+    else:
+        positions_by_bucket = matching.group_by_prefix(brand_strings, get_prefix_key)
+    cache_keys, cached_results, new_positions = {}, [], []
+    for bucket, positions in positions_by_bucket.items():
+        if result_cache is None:
+            # without the cache there is nothing to key, and hashing the buckets would be wasted
+            new_positions.extend(positions)
+            continue
+        prefixes = list(constants.BRAND_PREFIX_TO_FILE_NAME) if bucket == "*" else [bucket]
+        bucket_hash = match_cache.table_hash([get_preprocessed_data(preprocessed_data_cache, prefix) for prefix in prefixes])
+        cache_keys[bucket] = (bucket, bucket_hash, f"JaroWinkler.distance/{engine_key(engine)}",
+                              constants.NEAREST_MATCH_CUTOFF, constants.NEAREST_MATCH_LIMIT)
+        queries = [brand_strings[position] for position in positions]
+        cached = result_cache.get(*cache_keys[bucket], queries)
+        for position, query in zip(positions, queries):
+            if query in cached:
+                cached_results.append((position, cached[query]))
+            else:
+                new_positions.append(position)
+    print(f"{len(cached_results)} brand strings have cached matches, searching {len(new_positions)}")
+    new_results = {bucket: {} for bucket in positions_by_bucket}
+
+    def search_new_positions():
+        for new_position, result in search([brand_strings[position] for position in new_positions],
+                                           preprocessed_data_cache, search_all_buckets):
+            position = new_positions[new_position]
+            bucket = "*" if search_all_buckets else get_prefix_key(brand_strings[position][0])
+            new_results[bucket][brand_strings[position]] = result
+            yield position, result
+    # matches are written as they come, sorted by distance in runs that are merged at the end
+    writer = storage.SortedCsvWriter(
+        constants.CLOSEST_BRANDS_CSV,
+        ["iri_brand_string", "found_brand_string", "jarowinkler_distance", "brand_id", "symbol_id", "asin"],
+        sort_column="jarowinkler_distance",
+        run_rows=constants.NEAREST_MATCH_RUN_ROWS
     )
-    output_df = output_df.sort_values(by="jarowinkler_distance", ascending=True)
-    output_df.to_csv(constants.CLOSEST_BRANDS_CSV, index=False)
+    for position, result in itertools.chain(cached_results, search_new_positions()):
+        writer.write_rows([
+            (
+                brand_strings[position],
+                extracted_string,
+                jarowinkler_distance,
+                brand_ids[position],
+                symbol_ids[position],
+                product_asin,
+            )
+            for extracted_string, jarowinkler_distance, product_asin in result
+        ])
+    writer.close()
+    if result_cache is not None:
+        for bucket, results in new_results.items():
+            result_cache.put(*cache_keys[bucket], results)
+        result_cache.close()
+    profiling.current_span()["rows_in"] = len(brand_strings)
+    profiling.current_span()["rows_out"] = writer.rows
 
 
 
+@profiling.stage("load_into_bq")
 def load_into_bq():
     client = bigquery.Client()
     table_id = f"cei-data-science.webscrape.brand_string_to_brand_id_map"
@@ -379,27 +749,35 @@ def load_into_bq():
 
     load_job.result()
     print(f"Loaded {load_job.output_rows} rows into {table_id}.")
+    # cached report and graph queries that read the table have results from before the upload
+    if constants.QUERY_CACHE_DIR:
+        dropped = CachedQueryClient(None).invalidate(table=table_id)
+        print(f"Dropped {dropped} cached query results that read {table_id}.")
 
-def create_report():
+@profiling.stage("create_report")
+def create_report(client=None):
     def get_csv_row_counts(path):
         """
-        Counts the number of rows in all CSV files within a given directory.
+        Counts the number of rows in all CSV files within a given directory,
+        from the sidecars their writers left when they are up to date.
         """
         row_counts = {}
         if os.path.isfile(path) and path.endswith(".csv"):
             try:
-                df = pd.read_csv(path)
-                row_counts[os.path.basename(path)] = len(df)
+                row_counts[os.path.basename(path)] = storage.count_rows(path)
             except Exception as e:
                 print(f"Error reading {path}: {e}")
 
         elif os.path.isdir(path):
             for file in os.listdir(path):
-                if file.endswith(".csv"):
-                    file_path = os.path.join(path, file)
+                file_path = os.path.join(path, file)
+                # skip CSVs that have been superseded by a parquet copy
+                if file.endswith(".csv") and storage.table_path(file_path) != file_path \
+                        and os.path.exists(storage.table_path(file_path)):
+                    continue
+                if file.endswith(".csv") or file.endswith(".parquet"):
                     try:
-                        df = pd.read_csv(file_path)
-                        row_counts[file] = len(df)
+                        row_counts[file] = storage.count_rows(file_path)
                     except Exception as e:
                         print(f"Error reading {file}: {e}")
         else:
@@ -410,7 +788,6 @@ def create_report():
     mapped_entries = get_csv_row_counts(constants.DELIVERABLE_MAPPED_BRANDS_CSV)
     total_products = sum(total_entries.values())
     coverage_percentage = (list(mapped_entries.values())[0] / total_products) * 100 if total_products > 0 else 0
-    client = bigquery.Client()
 
     pre_tagging_mapped_entries_query = """
 SELECT 
@@ -426,9 +803,6 @@ WHERE
 GROUP BY product_brand_id;
     """
 
-    query_job = client.query(pre_tagging_mapped_entries_query)
-    pre_tagging_df = query_job.to_dataframe()
-
     post_tagging_mapped_entries_query = """
         WITH coverage_either_price_paid AS (
             SELECT 
@@ -453,8 +827,6 @@ GROUP BY product_brand_id;
         )
         SELECT * FROM coverage_either_price_paid;
     """
-    query_job = client.query(post_tagging_mapped_entries_query)
-    post_tagging_df = query_job.to_dataframe()
 
     total_entries_query = """
         SELECT 
@@ -463,8 +835,14 @@ GROUP BY product_brand_id;
         FROM `cei-data-science.helios_raw.helios_cleaned_product_brand`
         WHERE DATE(trans_date) > DATE('2020-01-01');
     """
-    query_job = client.query(total_entries_query)
-    total_entries_df = query_job.to_dataframe()
+    # the three queries are independent and run concurrently
+    with profiling.timer("query"):
+        results = run_queries({
+            "pre_tagging": pre_tagging_mapped_entries_query,
+            "post_tagging": post_tagging_mapped_entries_query,
+            "total_entries": total_entries_query,
+        }, client)
+    pre_tagging_df, post_tagging_df, total_entries_df = results["pre_tagging"], results["post_tagging"], results["total_entries"]
     all_helios_entries = total_entries_df["total_entries"].iloc[0]
     all_helios_price_paid = total_entries_df["total_price_paid"].iloc[0]
     # Calculate pre-tagging and post-tagging coverage as a percentage of total entries
@@ -530,11 +908,27 @@ def main():
         action="store_true",
         help="preprocess the data",
     )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="number of processes used to preprocess prefix buckets in parallel",
+    )
+    parser.add_argument(
+        "--force",
+        action="store_true",
+        help="rerun the stage even if the run manifest shows nothing it depends on has changed",
+    )
     parser.add_argument(
         "--map_data",
         action="store_true",
         help="Map brand_ids to their brands"
     )
+    parser.add_argument(
+        "--checkpoint",
+        action="store_true",
+        help="with --map_data, write the matches and cleaned buckets after every data source instead of once at the end",
+    )
     parser.add_argument(
         "--get_count",
         action="store_true",
@@ -545,6 +939,18 @@ def main():
         action="store_true",
         help="get closest match with jaro winkler (weighted prefix)",
     )
+    parser.add_argument(
+        "--search_all_buckets",
+        action="store_true",
+        help="with --get_closest_match, also search the other prefix buckets",
+    )
+    parser.add_argument(
+        "--engine",
+        choices=["blocking", "cdist", "tfidf"],
+        default=constants.NEAREST_MATCH_ENGINE,
+        help="with --get_closest_match, the search engine: exhaustive within the cutoff (blocking, or cdist "
+             "on all cores) or approximate over character n-grams (tfidf)",
+    )
     parser.add_argument(
         "--upload",
         action="store_true",
@@ -560,31 +966,110 @@ def main():
         action="store_true",
         help="create a report"
     )
+    parser.add_argument(
+        "--refresh",
+        action="store_true",
+        help="with --stats, rerun the queries instead of using their cached results",
+    )
+    parser.add_argument(
+        "--profile",
+        nargs="?",
+        const=constants.PROFILE_TRACE_JSON,
+        help=f"write per stage and per bucket timings, row counts and cache statistics to a JSON trace "
+             f"({constants.PROFILE_TRACE_JSON} by default)",
+    )
+    parser.add_argument(
+        "--profile_stacks",
+        help="with --profile, also sample call stacks and write them here in folded (flamegraph) format",
+    )
     args = parser.parse_args()
+    if args.profile:
+        profiling.enable(args.profile, args.profile_stacks)
     if args.preprocess:
-        preprocess_data()
+        preprocess_data(args.workers, args.force)
     elif args.create_clusters_from_sources:
         # Create brand_id to brand string map from iri or gs1
         for data_source in constants.DATA_SOURCES:
-            get_brand_id_map(data_source)
+            manifest.run_stage(
+                "create_clusters", data_source,
+                inputs=[constants.get_source_brands_file(data_source), constants.SALES_RANK_CSV],
+                outputs=[constants.get_brand_cluster_store_file(data_source), constants.get_brand_clusters_file(data_source)],
+                run=lambda: get_brand_id_map(data_source),
+                force=args.force
+            )
 
     elif args.map_data:
-        list_of_mapped_dfs = []
-        for data_source in constants.DATA_SOURCES:
-            match_brand_str_to_brand_id(data_source)
-            # compares mapped_brands_with_indices and duplicates.csv and maps the duplicates
-            list_of_mapped_dfs.append(get_all_matches())
-            # mapped_brands_with_indices will be stale
-            # deletes duplicates and preprocess entries that are already mapped
-            clean_data()
-        write_mapped_brands(list_of_mapped_dfs)
+        @profiling.stage("map_data")
+        def map_data():
+            list_of_mapped_dfs = []
+            # every bucket is loaded once and the stages pass their frames along in memory.
+            # Cleaned buckets are written at the end, or after every data source with --checkpoint
+            store = storage.BucketStore()
+            for data_source in constants.DATA_SOURCES:
+                mapped_df = match_brand_str_to_brand_id(data_source, store, write_output=args.checkpoint)
+                # compares mapped_brands_with_indices and duplicates.csv and maps the duplicates
+                list_of_mapped_dfs.append(get_all_matches(mapped_df, store))
+                # mapped_brands_with_indices will be stale
+                # deletes duplicates and preprocess entries that are already mapped
+                clean_data(mapped_df, store)
+                if args.checkpoint:
+                    store.persist()
+            if not args.checkpoint:
+                write_brands_that_match(mapped_df)
+            store.persist()
+            store_stats = store.stats()
+            profiling.current_span()["bucket_store"] = store_stats
+            print(f"Bucket tables: {store_stats['hits']} cache hits, {store_stats['misses']} reads, "
+                  f"{store_stats['evictions']} evicted, peak {store_stats['peak_bytes'] / 2 ** 20:.1f} MB")
+            # clean_data keeps the brand counts up to date
+            write_mapped_brands(list_of_mapped_dfs)
+
+        def preprocess_and_map_data():
+            # clean_data starts from the buckets as preprocess wrote them. Buckets an earlier map_data
+            # already cleaned are preprocessed again first, the others are up to date and skipped
+            preprocess_data(args.workers)
+            map_data()
+
+        # clean_data rewrites the preprocessed buckets, so they are tracked as outputs: the stage is up to date
+        # while they are still in the state it left them in, and its input is the preprocess run of each bucket.
+        # There is one key for all buckets: the data sources are mapped in turn against the buckets the previous
+        # one cleaned, and every bucket ends up in the same two output CSVs, so a bucket can't be redone alone
+        manifest.run_stage(
+            "map_data", "all",
+            inputs=[constants.get_brand_cluster_store_file(data_source) for data_source in constants.DATA_SOURCES]
+                   + [constants.get_brand_clusters_file(data_source) for data_source in constants.DATA_SOURCES]
+                   + [constants.MANUAL_CLUSTERS_JSON]
+                   + [os.path.join(constants.DATA_DIRECTORY, csv_file) for csv_file in constants.BRAND_PREFIX_TO_FILE_NAME.values()],
+            outputs=[constants.BRANDS_THAT_MATCH_CSV, constants.DELIVERABLE_MAPPED_BRANDS_CSV]
+                    + [constants.DUPLICATE_FILE(key) for key in constants.BRAND_PREFIX_TO_FILE_NAME]
+                    + [constants.PREPROCESSED_FILE(key) for key in constants.BRAND_PREFIX_TO_FILE_NAME]
+                    + [constants.BRAND_COUNT_FILE(key) for key in constants.BRAND_PREFIX_TO_FILE_NAME],
+            run=preprocess_and_map_data,
+            force=args.force,
+            upstream=[("preprocess", key) for key in constants.BRAND_PREFIX_TO_FILE_NAME]
+        )
+    elif args.get_count:
+        # full recount of the brand counts that clean_data keeps up to date
         count_duplicates()
     elif args.get_closest_match:
-        find_nearest_match('iri')
+        search_all_buckets = args.search_all_buckets or constants.NEAREST_MATCH_SEARCH_ALL_BUCKETS
+        # the search settings are part of the key, so switching them reruns the stage
+        stage_key = ",".join(
+            ["iri"] + (["all_buckets"] if search_all_buckets else []) + ([engine_key(args.engine)] if args.engine != "blocking" else [])
+        )
+        manifest.run_stage(
+            "closest_match", stage_key,
+            inputs=[constants.get_brand_cluster_store_file("iri"), constants.get_brand_clusters_file("iri"),
+                    constants.MANUAL_CLUSTERS_JSON]
+                   + [constants.PREPROCESSED_FILE(key) for key in constants.BRAND_PREFIX_TO_FILE_NAME],
+            outputs=[constants.CLOSEST_BRANDS_CSV],
+            run=lambda: find_nearest_match('iri', search_all_buckets, args.engine),
+            force=args.force
+        )
     elif args.upload:
         load_into_bq()
     elif args.stats:
-        create_report()
+        create_report(get_client(refresh=args.refresh))
     else:
         # distance_check()
         print("Invalid selection")
@@ -0,0 +1,97 @@
+import os
+import json
+import constants
+import storage
+
+
+def load_manifest():
+    """
+    Load the run manifest: content hashes of the files each stage read and wrote on its last run.
+    """
+    if os.path.exists(constants.RUN_MANIFEST_JSON):
+        with open(constants.RUN_MANIFEST_JSON, "r") as file:
+            return json.load(file)
+    return {"files": {}, "stages": {}}
+
+
+def save_manifest(manifest):
+    with open(constants.RUN_MANIFEST_JSON, "w") as file:
+        json.dump(manifest, file, indent=4, sort_keys=True)
+
+
+def file_hash(manifest, path):
+    """
+    sha256 of a file, None if it doesn't exist.
+    Hashes are memoized in the manifest by size and modification time, so unchanged files aren't re-read.
+    """
+    path = storage.existing_path(path)
+    if not os.path.exists(path):
+        return None
+    stat = os.stat(path)
+    known = manifest["files"].get(path)
+    if known and known["size"] == stat.st_size and known["mtime_ns"] == stat.st_mtime_ns:
+        return known["hash"]
+
+    # the writer's sidecar already has the hash of the file as written
+    metadata = storage.read_metadata(path)
+    digest = metadata["sha256"] if metadata is not None else storage.file_sha256(path)
+    manifest["files"][path] = {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "hash": digest}
+    return digest
+
+
+def fingerprint(manifest, paths):
+    return {path: file_hash(manifest, path) for path in paths}
+
+
+def stage_outputs(manifest, upstream):
+    """
+    The outputs recorded by the last run of each (stage, key) in upstream, None for the ones that never ran.
+    For stages whose inputs are files another stage wrote and that are rewritten later, like the buckets
+    clean_data rewrites after preprocessing.
+    """
+    return {
+        f"{stage},{key}": manifest["stages"].get(stage, {}).get(key, {}).get("outputs")
+        for stage, key in upstream
+    }
+
+
+def is_up_to_date(manifest, stage, key, inputs, outputs, upstream=()):
+    """
+    True if the last run of stage for key read the same inputs, after the same runs of the upstream stages,
+    and its outputs haven't been touched since.
+    """
+    recorded = manifest["stages"].get(stage, {}).get(key)
+    if recorded is None:
+        return False
+    current_outputs = fingerprint(manifest, outputs)
+    return (
+        None not in current_outputs.values()
+        and recorded["inputs"] == fingerprint(manifest, inputs)
+        and recorded.get("upstream", {}) == stage_outputs(manifest, upstream)
+        and recorded["outputs"] == current_outputs
+    )
+
+
+def record_stage(manifest, stage, key, inputs, outputs, upstream=()):
+    """
+    Record the inputs and outputs of a finished run of stage for key.
+    """
+    manifest["stages"].setdefault(stage, {})[key] = {
+        "inputs": fingerprint(manifest, inputs),
+        "upstream": stage_outputs(manifest, upstream),
+        "outputs": fingerprint(manifest, outputs),
+    }
+
+
+def run_stage(stage, key, inputs, outputs, run, force=False, upstream=()):
+    """
+    Run a pipeline stage unless nothing it depends on changed since its last run, then record it.
+    """
+    if not force and is_up_to_date(load_manifest(), stage, key, inputs, outputs, upstream):
+        print(f"{stage} ({key}) is up to date, skipping. Use --force to rerun it")
+        return
+    run()
+    # run may have recorded upstream stages in the meantime
+    manifest = load_manifest()
+    record_stage(manifest, stage, key, inputs, outputs, upstream)
+    save_manifest(manifest)
@@ -0,0 +1,91 @@
+import json
+import sqlite3
+import hashlib
+import pandas as pd
+import constants
+import profiling
+
+
+def table_hash(dfs, columns=("brand", "asin")):
+    """
+    sha256 of the given columns of one or more tables, row order included.
+    """
+    digest = hashlib.sha256()
+    for df in dfs:
+        digest.update(str(len(df)).encode())
+        digest.update(pd.util.hash_pandas_object(df[list(columns)], index=False).to_numpy().tobytes())
+    return digest.hexdigest()
+
+
+def json_default(value):
+    # missing values, e.g. the ASIN of a brand without one, are stored as null
+    if value is pd.NA:
+        return None
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
+class MatchCache:
+    """
+    Match results of earlier runs in a local SQLite database, keyed by query string, scorer, cutoff and limit,
+    and by the bucket searched and the content hash it had. The results of a bucket are dropped the first
+    time it is looked up with another hash, so only new query strings and changed buckets are rescored.
+    """
+
+    def __init__(self, path=None):
+        self.path = path if path is not None else constants.MATCH_CACHE_DB
+        self.connection = sqlite3.connect(self.path)
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS matches ("
+            "bucket TEXT NOT NULL, bucket_hash TEXT NOT NULL, scorer TEXT NOT NULL, cutoff REAL NOT NULL, "
+            "max_results INTEGER NOT NULL, query TEXT NOT NULL, result TEXT NOT NULL, "
+            "PRIMARY KEY (bucket, scorer, cutoff, max_results, query))"
+        )
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, bucket, bucket_hash, scorer, cutoff, limit, queries):
+        """
+        Cached results of the queries that have one, as a query -> result dict.
+        """
+        with profiling.timer("io"):
+            # results of the bucket's previous content for this scorer can't be hit anymore
+            evicted = self.connection.execute(
+                "DELETE FROM matches WHERE bucket = ? AND scorer = ? AND bucket_hash != ?",
+                (bucket, scorer, bucket_hash)
+            ).rowcount
+            self.connection.commit()
+            cached = {
+                query: result for query, result in self.connection.execute(
+                    "SELECT query, result FROM matches "
+                    "WHERE bucket = ? AND bucket_hash = ? AND scorer = ? AND cutoff = ? AND max_results = ?",
+                    (bucket, bucket_hash, scorer, cutoff, limit)
+                )
+            }
+        results = {query: json.loads(cached[query]) for query in set(queries) if query in cached}
+        hits = sum(query in results for query in queries)
+        self.hits += hits
+        self.misses += len(queries) - hits
+        self.evictions += evicted
+        profiling.count("match_cache_hits", hits)
+        profiling.count("match_cache_misses", len(queries) - hits)
+        profiling.count("match_cache_evictions", evicted)
+        return results
+
+    def put(self, bucket, bucket_hash, scorer, cutoff, limit, results):
+        """
+        Store a query -> result dict. Results are JSON, so lists come back for tuples.
+        """
+        with profiling.timer("io"):
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO matches VALUES (?, ?, ?, ?, ?, ?, ?)",
+                [(bucket, bucket_hash, scorer, cutoff, limit, query, json.dumps(result, default=json_default))
+                 for query, result in results.items()]
+            )
+            self.connection.commit()
+
+    def close(self):
+        self.connection.close()
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses, "evictions": self.evictions}
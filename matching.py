@@ -0,0 +1,272 @@
+from bisect import bisect_left
+import numpy as np
+import constants
+from rapidfuzz import distance
+from rapidfuzz.process import cdist, extract
+
+
+def group_by_prefix(brand_strings, get_key):
+    """
+    Group the positions of brand_strings by the prefix bucket their first character resolves to.
+    Positions keep their original order within each bucket.
+    """
+    positions_by_prefix = {}
+    for position, brand_string in enumerate(brand_strings):
+        positions_by_prefix.setdefault(get_key(brand_string[0]), []).append(position)
+    return positions_by_prefix
+
+
+def build_exact_index(choices):
+    """
+    Hash index from brand string to the position of its first occurrence in choices.
+    """
+    exact_index = {}
+    for position, choice in enumerate(choices):
+        if isinstance(choice, str):
+            exact_index.setdefault(choice, position)
+    return exact_index
+
+
+def match_exact(queries, exact_index):
+    """
+    Resolve queries through an index from build_exact_index.
+    Same result as match_bucket with a Jaro-Winkler score_cutoff of 0, which only accepts identical strings.
+    """
+    return np.fromiter((exact_index.get(query, -1) for query in queries), dtype=np.int64, count=len(queries))
+
+
+def match_bucket(queries, choices, scorer=distance.JaroWinkler.distance, score_cutoff=0.0,
+                 workers=constants.MATCH_WORKERS):
+    """
+    Score every query against the same choice list in batched cdist calls.
+    Returns an array with the index of the best choice for each query (first one on ties, like extractOne),
+    or -1 where no choice is within score_cutoff.
+    """
+    best_indices = np.full(len(queries), -1, dtype=np.int64)
+    if len(queries) == 0 or len(choices) == 0:
+        return best_indices
+
+    # bound the score matrix to MATCH_CHUNK_CELLS entries
+    chunk_size = max(1, constants.MATCH_CHUNK_CELLS // len(choices))
+    for start in range(0, len(queries), chunk_size):
+        scores = cdist(
+            queries[start:start + chunk_size],
+            choices,
+            scorer=scorer,
+            score_cutoff=score_cutoff,
+            workers=workers
+        )
+        chunk_best = scores.argmin(axis=1)
+        found = scores[np.arange(len(chunk_best)), chunk_best] <= score_cutoff
+        best_indices[start:start + len(chunk_best)] = np.where(found, chunk_best, -1)
+    return best_indices
+
+
+def top_k_bucket(queries, choices, scorer=distance.JaroWinkler.distance, score_cutoff=0.0, limit=10,
+                 workers=constants.MATCH_WORKERS):
+    """
+    For every query, the `limit` best choices within score_cutoff as (choice index, score) pairs,
+    best first and in choice order on ties, like extract.
+    Queries are scored in batched cdist calls on all cores, and every score matrix is reduced to its
+    top `limit` entries per query before the next one is computed.
+    """
+    results = []
+    if len(choices) == 0:
+        return [[] for _ in queries]
+    # bound the score matrix to MATCH_CHUNK_CELLS entries
+    chunk_size = max(1, constants.MATCH_CHUNK_CELLS // len(choices))
+    for start in range(0, len(queries), chunk_size):
+        scores = cdist(
+            queries[start:start + chunk_size],
+            choices,
+            scorer=scorer,
+            score_cutoff=score_cutoff,
+            dtype=np.float64,
+            workers=workers
+        )
+        # only the entries within the cutoff, by query, then score, then choice.
+        # rapidfuzz accepts scores a rounding error over the cutoff, everything else is set past it
+        rows, columns = np.nonzero(scores <= score_cutoff + 1e-9)
+        values = scores[rows, columns]
+        order = np.lexsort((columns, values, rows))
+        rows, columns, values = rows[order], columns[order], values[order]
+        boundaries = np.searchsorted(rows, np.arange(len(scores) + 1))
+        for row in range(len(scores)):
+            end = min(boundaries[row + 1], boundaries[row] + limit)
+            results.append(list(zip(columns[boundaries[row]:end].tolist(), values[boundaries[row]:end].tolist())))
+    return results
+
+
+# Character classes of the blocking signatures. Everything else shares the last class,
+# which can only overestimate the characters two strings have in common
+SIGNATURE_CLASSES = {character: position for position, character in enumerate("ABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789 _")}
+SIGNATURE_WIDTH = len(SIGNATURE_CLASSES) + 1
+SIGNATURE_LOOKUP = np.full(128, SIGNATURE_WIDTH - 1, dtype=np.int64)
+for _character, _position in SIGNATURE_CLASSES.items():
+    SIGNATURE_LOOKUP[ord(_character)] = _position
+
+
+def character_signatures(strings, chunk_size=100_000, dtype=np.uint16):
+    """
+    Per-string character class counts, as an (n, SIGNATURE_WIDTH) matrix of dtype.
+    Counts are capped at the largest value of dtype.
+    """
+    signatures = np.zeros((len(strings), SIGNATURE_WIDTH), dtype=dtype)
+    for start in range(0, len(strings), chunk_size):
+        chunk = strings[start:start + chunk_size]
+        lengths = np.fromiter(map(len, chunk), dtype=np.int64, count=len(chunk))
+        code_points = np.frombuffer("".join(chunk).encode("utf-32-le"), dtype=np.uint32)
+        classes = np.where(code_points < 128, SIGNATURE_LOOKUP[np.minimum(code_points, 127)], SIGNATURE_WIDTH - 1)
+        rows = np.repeat(np.arange(len(chunk)), lengths)
+        counts = np.bincount(rows * SIGNATURE_WIDTH + classes, minlength=len(chunk) * SIGNATURE_WIDTH)
+        signatures[start:start + len(chunk)] = np.minimum(counts, np.iinfo(dtype).max).reshape(len(chunk), SIGNATURE_WIDTH)
+    return signatures
+
+
+class BlockingIndex:
+    """
+    Candidate blocking for Jaro-Winkler distance searches over one preprocessed bucket.
+
+    Jaro similarity is (m/|a| + m/|b| + (m - t)/m) / 3, where the m matched characters can't exceed
+    the characters the strings have in common, c. Winkler adds at most l * p * (1 - jaro) for a common
+    prefix of l <= 4 characters. A distance within score_cutoff therefore needs
+        c/|a| + c/|b| >= 3 * (1 - score_cutoff - l * p) / (1 - l * p) - 1
+    Rows sharing 2+ prefix characters with the query are a range of the brand-sorted rows and are checked
+    with their own prefix length. Every other row has l <= 1; since c <= min(|a|, |b|), the l = 1 bound
+    limits those to a length band, which is a slice of the length-sorted rows, and the rest of the band
+    is checked against character count signatures.
+    Rows that are dropped can't be within score_cutoff, so searching the candidates finds the same
+    matches as scanning the whole bucket.
+    """
+
+    def __init__(self, choices, prefix_weight=0.1):
+        self.choices = np.array(choices, dtype=object)
+        self.prefix_weight = prefix_weight
+        rows = np.array([position for position, choice in enumerate(choices) if isinstance(choice, str)], dtype=np.int64)
+        lengths = np.fromiter((len(choices[row]) for row in rows), dtype=np.int64, count=len(rows))
+        # rows, lengths and signatures are kept in length order
+        by_length = np.argsort(lengths, kind="stable")
+        self.rows = rows[by_length]
+        self.lengths = lengths[by_length]
+        self.inverse_lengths = 1 / np.maximum(self.lengths, 1)
+        self.signatures = np.ascontiguousarray(character_signatures(self.choices[self.rows].tolist()).T)
+        # a capped count only says the row has at least that many, so it can't bound the characters in common
+        self.signature_cap = np.iinfo(self.signatures.dtype).max
+        self.saturated = bool((self.signatures == self.signature_cap).any())
+        # brand order, to find the rows sharing a prefix with the query
+        self.by_brand = np.argsort(self.choices[self.rows], kind="stable")
+        self.sorted_brands = self.choices[self.rows][self.by_brand].tolist()
+
+    def _prefix_range(self, prefix, start=0, end=None):
+        # positions in sorted_brands of the brands starting with prefix
+        end = len(self.sorted_brands) if end is None else end
+        start = bisect_left(self.sorted_brands, prefix, start, end)
+        if ord(prefix[-1]) == 0x10FFFF:
+            return start, end
+        return start, bisect_left(self.sorted_brands, prefix[:-1] + chr(ord(prefix[-1]) + 1), start, end)
+
+    def _possible(self, positions, query_length, query_signature, required):
+        # character count check for rows at positions (length order) against the required bound
+        common = np.zeros(len(positions), dtype=np.int64)
+        for character_class in np.flatnonzero(query_signature):
+            counts = self.signatures[character_class, positions]
+            if self.saturated:
+                counts = np.where(counts == self.signature_cap, query_signature[character_class], counts)
+            common += np.minimum(counts, query_signature[character_class])
+        return common * (1 / query_length + self.inverse_lengths[positions]) >= required
+
+    def candidates(self, query, score_cutoff):
+        """
+        Row positions, in ascending order, of the choices that may be within score_cutoff of query.
+        """
+        query_length = len(query)
+        if query_length == 0 or len(self.rows) == 0:
+            return self.rows[:0]
+        # required c/|a| + c/|b| for each common prefix length
+        prefix_boost = np.arange(5) * self.prefix_weight
+        required = 3 * (1 - score_cutoff - prefix_boost) / (1 - prefix_boost) - 1 - 1e-9
+        if required[4] <= 1:
+            return np.sort(self.rows)
+        # the query's counts are exact
+        query_signature = character_signatures([query], dtype=np.int64)[0]
+
+        # rows sharing at least 2 prefix characters, with their exact prefix length (up to 4)
+        prefix_start, prefix_end = self._prefix_range(query[:2]) if query_length >= 2 else (0, 0)
+        common_prefix = np.full(prefix_end - prefix_start, 2, dtype=np.int64)
+        for prefix_length in range(3, min(4, query_length) + 1):
+            start, end = self._prefix_range(query[:prefix_length], prefix_start, prefix_end)
+            common_prefix[start - prefix_start:end - prefix_start] = prefix_length
+        prefix_positions = self.by_brand[prefix_start:prefix_end]
+        prefix_candidates = prefix_positions[
+            self._possible(prefix_positions, query_length, query_signature, required[common_prefix])
+        ]
+
+        # every other row, within the length band of the l = 1 bound
+        slack = required[1] - 1
+        if slack <= 0:
+            return np.sort(self.rows)
+        start = np.searchsorted(self.lengths, np.ceil(query_length * slack - 1e-9), side="left")
+        end = np.searchsorted(self.lengths, np.floor(query_length / slack + 1e-9), side="right")
+        band_positions = np.arange(start, max(start, end))
+        band_candidates = band_positions[
+            self._possible(band_positions, query_length, query_signature, required[1])
+        ]
+        return np.sort(self.rows[np.union1d(prefix_candidates, band_candidates)])
+
+
+class NgramIndex:
+    """
+    Approximate nearest-brand search over TF-IDF weighted character n-grams of the choices.
+    Cosine similarities come from chunked sparse products of the query and choice vectors; only the
+    best `candidates` choices of each query are re-scored with the real scorer.
+    Unlike BlockingIndex this can miss matches, in exchange for not depending on the bucket size per query,
+    which makes searching one index over all buckets affordable.
+    """
+
+    def __init__(self, choices, ngram_range=(2, 3)):
+        from sklearn.feature_extraction.text import TfidfVectorizer
+        self.choices = np.array(choices, dtype=object)
+        self.rows = np.array([position for position, choice in enumerate(choices) if isinstance(choice, str)], dtype=np.int64)
+        self.vectorizer = TfidfVectorizer(analyzer="char", ngram_range=ngram_range, lowercase=False, dtype=np.float32)
+        if len(self.rows):
+            try:
+                # (n-grams, choices), so a block of query vectors times it gives their similarity to every choice
+                self.vectors = self.vectorizer.fit_transform(self.choices[self.rows].tolist()).T.tocsr()
+            except ValueError:
+                # empty vocabulary: every choice is shorter than the smallest n-gram, so none can be a candidate
+                self.rows = self.rows[:0]
+
+    def candidates(self, queries, limit):
+        """
+        Yield, for every query, the row positions (ascending) of the `limit` choices most similar to it.
+        Queries sharing no n-gram with any choice get none.
+        """
+        if len(self.rows) == 0:
+            for _ in queries:
+                yield self.rows[:0]
+            return
+        query_vectors = self.vectorizer.transform(queries)
+        # bound the similarity matrix of a chunk to MATCH_CHUNK_CELLS entries
+        chunk_size = max(1, constants.MATCH_CHUNK_CELLS // len(self.rows))
+        for start in range(0, len(queries), chunk_size):
+            similarities = (query_vectors[start:start + chunk_size] @ self.vectors).tocsr()
+            for row in range(similarities.shape[0]):
+                scores = similarities.data[similarities.indptr[row]:similarities.indptr[row + 1]]
+                columns = similarities.indices[similarities.indptr[row]:similarities.indptr[row + 1]]
+                if len(scores) > limit:
+                    columns = columns[np.argpartition(-scores, limit - 1)[:limit]]
+                yield np.sort(self.rows[columns])
+
+    def search(self, queries, scorer=distance.JaroWinkler.distance, score_cutoff=None, limit=None,
+               candidates=constants.NEAREST_MATCH_NGRAM_CANDIDATES):
+        """
+        Yield, for every query, (choice, score, row) for up to `limit` of its candidates within score_cutoff,
+        best first, as rapidfuzz extract returns them.
+        """
+        for query, candidate_rows in zip(queries, self.candidates(queries, candidates)):
+            yield [
+                (choice, score, candidate_rows[index])
+                for choice, score, index in extract(
+                    query, self.choices[candidate_rows].tolist(), scorer=scorer, score_cutoff=score_cutoff, limit=limit
+                )
+            ]
@@ -0,0 +1,248 @@
+import os
+import sys
+import json
+import time
+import atexit
+import resource
+import threading
+from contextlib import contextmanager
+from functools import wraps
+
+# Spans of the current run, when profiling is enabled with --profile.
+# A span is one stage or prefix bucket: a dict of its timings, row counts and counters,
+# with the spans that ran inside it as children
+_enabled = False
+_spans = []
+_open_spans = []
+_sampler = None
+
+
+def peak_rss_mb(who=resource.RUSAGE_SELF):
+    if who == resource.RUSAGE_SELF:
+        # VmHWM is what reset_peak_rss() resets. ru_maxrss also keeps the peak of threads that exited
+        try:
+            with open("/proc/self/status") as file:
+                for line in file:
+                    if line.startswith("VmHWM:"):
+                        return int(line.split()[1]) / 2 ** 10
+        except OSError:
+            pass
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS
+    scale = 1 if sys.platform == "darwin" else 1024
+    return resource.getrusage(who).ru_maxrss * scale / 2 ** 20
+
+
+def reset_peak_rss():
+    """
+    Restart the peak RSS of this process from its current RSS, so the next peak_rss_mb() is the peak since now.
+    Only Linux allows it; returns whether it was reset.
+    """
+    try:
+        with open("/proc/self/clear_refs", "w") as file:
+            file.write("5")
+        return True
+    except OSError:
+        return False
+
+
+def enable(trace_path, stacks_path=None, sample_interval=0.005):
+    """
+    Start recording spans, written to trace_path as JSON when the process exits.
+    With stacks_path, the call stacks of all threads are also sampled every sample_interval seconds
+    and written there in the folded format read by flamegraph.pl and speedscope.
+    """
+    global _enabled, _sampler
+    _enabled = True
+    if stacks_path:
+        _sampler = StackSampler(sample_interval)
+        _sampler.start()
+    atexit.register(write_trace, trace_path, stacks_path)
+
+
+def is_enabled():
+    return _enabled
+
+
+def new_span(name, **attributes):
+    return {
+        "name": name,
+        **attributes,
+        "wall_seconds": 0.0,
+        "cpu_seconds": 0.0,
+        "io_seconds": 0.0,
+        "match_seconds": 0.0,
+        "rows_in": None,
+        "rows_out": None,
+        "rows_per_second": None,
+        "peak_rss_mb": None,
+        "counters": {},
+        "children": [],
+    }
+
+
+@contextmanager
+def span(name, detached=False, **attributes):
+    """
+    Time the block as a span nested in the innermost open one, and yield it so the block can set
+    rows_in and rows_out. A detached span isn't attached to its parent: it is meant to be returned
+    from a worker process and attached with add_span.
+    Without profiling the block still gets a dict to write to, which is thrown away.
+    """
+    record = new_span(name, **attributes)
+    if not _enabled:
+        yield record
+        return
+    if not detached:
+        (_open_spans[-1]["children"] if _open_spans else _spans).append(record)
+    _open_spans.append(record)
+    start_wall, start_cpu = time.perf_counter(), time.process_time()
+    try:
+        yield record
+    finally:
+        _open_spans.remove(record)
+        record["wall_seconds"] = time.perf_counter() - start_wall
+        record["cpu_seconds"] = time.process_time() - start_cpu
+        record["peak_rss_mb"] = round(peak_rss_mb(), 1)
+        rows = record["rows_in"] if record["rows_in"] is not None else record["rows_out"]
+        if rows is not None and record["wall_seconds"] > 0:
+            record["rows_per_second"] = rows / record["wall_seconds"]
+
+
+def stage(name):
+    """
+    Decorator running every call of a pipeline stage in its own span.
+    """
+    def decorator(function):
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            with span(name):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def current_span():
+    # the innermost open span, or a throwaway one without profiling
+    return _open_spans[-1] if _open_spans else new_span(None)
+
+
+def add_span(record):
+    # attach a span measured elsewhere, e.g. in a worker process, to the innermost open span
+    if _enabled and record is not None:
+        (_open_spans[-1]["children"] if _open_spans else _spans).append(record)
+
+
+class SpanTotals:
+    """
+    One span per key for work that is interleaved across keys, e.g. queries that each search several
+    buckets in turn. Every timed block adds its time and rows to its key's span; attach() adds the spans
+    to the innermost open one.
+    """
+
+    def __init__(self, name, key_name):
+        self.name = name
+        self.key_name = key_name
+        self.spans = {}
+
+    @contextmanager
+    def timer(self, key, rows=1):
+        if not _enabled:
+            yield
+            return
+        record = self.spans.setdefault(key, new_span(self.name, **{self.key_name: key}))
+        start_wall, start_cpu = time.perf_counter(), time.process_time()
+        try:
+            yield
+        finally:
+            record["wall_seconds"] += time.perf_counter() - start_wall
+            record["cpu_seconds"] += time.process_time() - start_cpu
+            record["rows_in"] = (record["rows_in"] or 0) + rows
+
+    def attach(self):
+        for record in self.spans.values():
+            if record["wall_seconds"] > 0:
+                record["rows_per_second"] = record["rows_in"] / record["wall_seconds"]
+            add_span(record)
+
+
+@contextmanager
+def timer(category):
+    """
+    Add the time spent in the block to the "{category}_seconds" of every open span,
+    e.g. timer("io") around file reads and writes and timer("match") around string matching.
+    """
+    if not _open_spans:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        for record in list(_open_spans):
+            record[f"{category}_seconds"] = record.get(f"{category}_seconds", 0.0) + elapsed
+
+
+def count(counter, value=1):
+    # add value to a counter of every open span
+    for record in _open_spans:
+        record["counters"][counter] = record["counters"].get(counter, 0) + value
+
+
+def count_cache(cache, hit):
+    count(f"{cache}_{'hits' if hit else 'misses'}")
+
+
+def write_trace(trace_path, stacks_path=None):
+    if _sampler is not None:
+        _sampler.stop()
+        _sampler.write(stacks_path)
+        print(f"Stack samples saved to {stacks_path}")
+    trace = {
+        "argv": sys.argv,
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "peak_rss_mb": round(peak_rss_mb(), 1),
+        # worker processes, e.g. preprocess_data --workers
+        "peak_children_rss_mb": round(peak_rss_mb(resource.RUSAGE_CHILDREN), 1),
+        "spans": _spans,
+    }
+    with open(trace_path, "w") as file:
+        json.dump(trace, file, indent=4)
+    print(f"Profile saved to {trace_path}")
+
+
+class StackSampler(threading.Thread):
+    """
+    Samples the call stack of every other thread at a fixed interval and counts identical stacks.
+    """
+
+    def __init__(self, interval):
+        super().__init__(daemon=True)
+        self.interval = interval
+        self.stacks = {}
+        self._stopped = threading.Event()
+
+    def run(self):
+        while not self._stopped.wait(self.interval):
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == self.ident:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)})")
+                    frame = frame.f_back
+                stack.append(names.get(thread_id, str(thread_id)))
+                key = ";".join(reversed(stack))
+                self.stacks[key] = self.stacks.get(key, 0) + 1
+
+    def stop(self):
+        self._stopped.set()
+        self.join()
+
+    def write(self, path):
+        # one "root;...;leaf count" line per distinct stack
+        with open(path, "w") as file:
+            for stack, samples in sorted(self.stacks.items()):
+                file.write(f"{stack} {samples}\n")
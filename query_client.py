@@ -0,0 +1,260 @@
+import os
+import re
+import json
+import time
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import constants
+import profiling
+
+
+class BigQueryClient:
+    """
+    The query interface the extraction and reporting code runs against.
+    Wraps a google.cloud.bigquery.Client, which is only created on first use.
+    """
+
+    def __init__(self, client=None):
+        self._client = client
+        # queries can be submitted from several threads at once
+        self._lock = threading.Lock()
+
+    @property
+    def client(self):
+        with self._lock:
+            if self._client is None:
+                from google.cloud import bigquery
+                self._client = bigquery.Client()
+        return self._client
+
+    def query_dataframe(self, sql):
+        return self.client.query(sql).to_dataframe()
+
+    def query_pages(self, sql, page_size=None):
+        """
+        Yield the result of sql as DataFrames, one per page, as pages arrive.
+        """
+        rows = self.client.query(sql).result(page_size=page_size)
+        yield from rows.to_dataframe_iterable()
+
+
+class LocalQueryClient:
+    """
+    Local stand-in for BigQueryClient in tests and benchmarks.
+    handler(sql) returns the result DataFrame, e.g. by running the query against SQLite
+    or by looking it up in a dict of canned results.
+    """
+
+    def __init__(self, handler):
+        self.handler = handler
+        self.queries = []
+
+    def query_dataframe(self, sql):
+        self.queries.append(sql)
+        return self.handler(sql)
+
+    def query_pages(self, sql, page_size=None):
+        df = self.query_dataframe(sql)
+        page_size = page_size or max(len(df), 1)
+        for start in range(0, len(df), page_size):
+            yield df.iloc[start:start + page_size].reset_index(drop=True)
+
+
+# quoted strings and identifiers, which are kept as they are, or runs of whitespace and comments
+SQL_TOKENS = re.compile(r"""('(?:[^'\\]|\\.)*'|"(?:[^"\\]|\\.)*"|`[^`]*`)|(?:\s|--[^\n]*|#[^\n]*|/\*.*?\*/)+""", re.DOTALL)
+
+
+def normalize_sql(sql):
+    """
+    sql without comments and with runs of whitespace outside of quoted strings and identifiers collapsed
+    to one space, so re-indenting or commenting a query doesn't change its cache key.
+    A line comment ends at its newline, so it can't swallow the next line.
+    """
+    return SQL_TOKENS.sub(lambda match: match.group(1) or " ", sql).strip().rstrip(";").strip()
+
+
+def query_key(sql, params=None):
+    # cache key of a query: sha256 of its normalized SQL and of anything else its result depends on
+    payload = json.dumps({"sql": normalize_sql(sql), "params": params or {}}, sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+
+class CachedQueryClient:
+    """
+    Keeps the results of the queries run through client in a local directory, as compressed Arrow files
+    named by query_key, and answers repeated queries from there until they are older than ttl_seconds.
+    With refresh, every query is run again and its cached result replaced.
+    """
+
+    def __init__(self, client, directory=None, ttl_seconds=None, refresh=False, params=None):
+        self.client = client
+        self.directory = directory if directory is not None else constants.QUERY_CACHE_DIR
+        self.ttl_seconds = ttl_seconds if ttl_seconds is not None else constants.QUERY_CACHE_TTL_SECONDS
+        self.refresh = refresh
+        # e.g. the project the queries run in
+        self.params = params
+        os.makedirs(self.directory, exist_ok=True)
+
+    def path(self, sql):
+        return os.path.join(self.directory, f"{query_key(sql, self.params)}.arrow")
+
+    def cached_path(self, sql):
+        # the cached result of sql, None if there is none, it expired or refresh is on
+        path = self.path(sql)
+        if self.refresh or not os.path.exists(path):
+            return None
+        if time.time() - os.path.getmtime(path) > self.ttl_seconds:
+            return None
+        return path
+
+    def invalidate(self, sql=None, table=None):
+        """
+        Drop the cached result of sql, of every query that reads table, or of every query without either.
+        Returns the number of results dropped.
+        """
+        if sql is not None:
+            paths = [self.path(sql)]
+        else:
+            paths = [os.path.join(self.directory, name) for name in os.listdir(self.directory) if name.endswith(".arrow")]
+        if table is not None:
+            paths = [path for path in paths if self.reads_table(path, table)]
+        dropped = 0
+        for path in paths:
+            if os.path.exists(path):
+                os.remove(path)
+                dropped += 1
+        return dropped
+
+    def reads_table(self, path, table):
+        """
+        Whether the query cached in path mentions table, by its name without project and dataset.
+        Results cached without their SQL are assumed to.
+        """
+        import pyarrow as pa
+        metadata = pa.ipc.open_file(pa.memory_map(path, "r")).schema.metadata or {}
+        sql = metadata.get(b"sql")
+        return sql is None or table.split(".")[-1] in sql.decode()
+
+    def read_table(self, path):
+        import pyarrow as pa
+        # memory-mapped: only the compressed buffers are decompressed, without reading the file into memory first
+        return pa.ipc.open_file(pa.memory_map(path, "r")).read_all()
+
+    def query_dataframe(self, sql):
+        path = self.cached_path(sql)
+        if path is not None:
+            print(f"Using cached result {os.path.basename(path)}")
+            return self.read_table(path).to_pandas()
+        df = self.client.query_dataframe(sql)
+        with ResultWriter(self.path(sql), normalize_sql(sql)) as writer:
+            writer.write(df)
+        return df
+
+    def query_pages(self, sql, page_size=None):
+        path = self.cached_path(sql)
+        if path is not None:
+            print(f"Using cached result {os.path.basename(path)}")
+            table = self.read_table(path)
+            page_size = page_size or max(table.num_rows, 1)
+            for start in range(0, table.num_rows, page_size):
+                yield table.slice(start, page_size).to_pandas()
+            return
+        # pages are cached as they stream through, the result is only kept once it is complete
+        with ResultWriter(self.path(sql), normalize_sql(sql)) as writer:
+            for page in self.client.query_pages(sql, page_size=page_size):
+                writer.write(page)
+                yield page
+
+
+class ResultWriter:
+    """
+    Write DataFrames to one compressed Arrow file, next to path until it is complete, with the SQL
+    of the query in the schema metadata.
+    A result Arrow can't store isn't cached, and the query goes on without the cache.
+    """
+
+    def __init__(self, path, sql=None):
+        self.path = path
+        self.sql = sql
+        self._temporary_path = f"{path}.{os.getpid()}.{threading.get_ident()}.partial"
+        self._writer = None
+        self._schema = None
+        self.failed = False
+
+    def write(self, df):
+        import pyarrow as pa
+        if self.failed:
+            return
+        try:
+            self._write(df)
+        except (pa.ArrowInvalid, pa.ArrowTypeError, pa.ArrowNotImplementedError) as e:
+            print(f"Not caching {os.path.basename(self.path)}: {e}")
+            self.failed = True
+
+    def _write(self, df):
+        import pyarrow as pa
+        if self._writer is None:
+            # columns that are all null on the first page are typed as strings, like storage.TableWriter
+            schema = pa.Schema.from_pandas(df, preserve_index=False)
+            self._schema = pa.schema([
+                field.with_type(pa.string()) if pa.types.is_null(field.type) else field for field in schema
+            ], metadata=schema.metadata)
+            if self.sql is not None:
+                self._schema = self._schema.with_metadata({**(self._schema.metadata or {}), b"sql": self.sql.encode()})
+            options = pa.ipc.IpcWriteOptions(compression=constants.QUERY_CACHE_COMPRESSION)
+            self._writer = pa.ipc.new_file(self._temporary_path, self._schema, options=options)
+        self._writer.write_table(pa.Table.from_pandas(df, schema=self._schema, preserve_index=False))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exception_type, exception, traceback):
+        if self._writer is None:
+            return False
+        self._writer.close()
+        if exception_type is None and not self.failed:
+            os.replace(self._temporary_path, self.path)
+        else:
+            # an interrupted or failed query isn't cached
+            os.remove(self._temporary_path)
+        return False
+
+
+def get_client(client=None, refresh=False):
+    # the default BigQuery client, behind the local result cache unless QUERY_CACHE_DIR turns it off,
+    # unless a client was injected
+    if client is not None:
+        return client
+    if constants.QUERY_CACHE_DIR:
+        return CachedQueryClient(BigQueryClient(), refresh=refresh)
+    return BigQueryClient()
+
+
+def uncached(client):
+    # the client behind the result cache, for queries whose result has to be current
+    return client.client if isinstance(client, CachedQueryClient) else client
+
+
+def run_queries(queries, client=None, max_workers=None):
+    """
+    Submit independent queries at once and collect their results, so the wait is the slowest query
+    instead of the sum of all of them. queries maps a name to its SQL; returns name -> DataFrame.
+    Prints how long each query took and records it in the current profiling span.
+    """
+    client = get_client(client)
+
+    def run(sql):
+        start = time.perf_counter()
+        df = client.query_dataframe(sql)
+        return df, time.perf_counter() - start
+
+    results, seconds = {}, {}
+    with ThreadPoolExecutor(max_workers=max_workers or len(queries)) as executor:
+        futures = {name: executor.submit(run, sql) for name, sql in queries.items()}
+        for name, future in futures.items():
+            results[name], seconds[name] = future.result()
+    for name, df in results.items():
+        print(f"Query {name}: {len(df)} rows in {seconds[name]:.2f}s")
+    profiling.current_span().setdefault("queries", {}).update(seconds)
+    return results
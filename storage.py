@@ -0,0 +1,381 @@
+import os
+import csv
+import json
+import heapq
+import hashlib
+from collections import OrderedDict
+import pandas as pd
+import constants
+import profiling
+
+
+def table_path(path):
+    """
+    Where a table is stored under the configured STORAGE_FORMAT.
+    Tables are named by their CSV path; with parquet storage the extension is swapped.
+    """
+    root, extension = os.path.splitext(path)
+    if constants.STORAGE_FORMAT == "parquet" and extension == ".csv":
+        return root + ".parquet"
+    return path
+
+
+def existing_path(path):
+    """
+    The file a table is currently read from: its table_path copy if there is one, else path itself.
+    """
+    stored_path = table_path(path)
+    return stored_path if os.path.exists(stored_path) else path
+
+
+def metadata_path(path):
+    # sidecar next to a written file
+    return path + ".meta.json"
+
+
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as file:
+        for block in iter(lambda: file.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def table_schema(df):
+    return {column: str(dtype) for column, dtype in df.dtypes.items()}
+
+
+def write_metadata(path, rows, schema):
+    """
+    Write the sidecar of a file that was just written: its row count, byte size, content hash and schema.
+    Its size and modification time are recorded too, to tell whether the file changed since.
+    """
+    stat = os.stat(path)
+    metadata = {
+        "rows": int(rows),
+        "bytes": stat.st_size,
+        "mtime_ns": stat.st_mtime_ns,
+        "sha256": file_sha256(path),
+        "schema": schema,
+    }
+    with open(metadata_path(path), "w") as file:
+        json.dump(metadata, file, indent=4)
+
+
+def read_metadata(path):
+    """
+    The sidecar of path, None if there is none or path was modified after it was written.
+    """
+    sidecar = metadata_path(path)
+    if not os.path.exists(sidecar) or not os.path.exists(path):
+        return None
+    with open(sidecar, "r") as file:
+        metadata = json.load(file)
+    stat = os.stat(path)
+    if metadata["bytes"] != stat.st_size or metadata["mtime_ns"] != stat.st_mtime_ns:
+        return None
+    return metadata
+
+
+def compact_strings(df):
+    """
+    df with its object (string) columns converted to the compact STRING_DTYPE.
+    """
+    if constants.STRING_DTYPE is None:
+        return df
+    return df.astype({column: constants.STRING_DTYPE for column, dtype in df.dtypes.items() if dtype == object})
+
+
+def release_unused_memory():
+    """
+    Hand the memory pyarrow's allocator keeps around after Arrow data is freed back to the OS,
+    e.g. after building a large table from pieces.
+    """
+    if constants.STRING_DTYPE is not None:
+        import pyarrow as pa
+        pa.default_memory_pool().release_unused()
+
+
+def read_table(path, columns=None):
+    """
+    Read a table written by write_table, only decoding the requested columns, with its string columns
+    in the compact STRING_DTYPE.
+    Falls back to the CSV file when there is no parquet copy yet (data extracted before switching formats).
+    """
+    stored_path = table_path(path)
+    with profiling.timer("io"):
+        if stored_path.endswith(".parquet") and os.path.exists(stored_path):
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+            # pyarrow decodes column chunks on all cores.
+            # Arrow strings are handed over as they are, without creating a Python object per value
+            table = pq.read_table(stored_path, columns=columns, use_threads=True)
+            if constants.STRING_DTYPE is None:
+                return table.to_pandas()
+            string_dtype = pd.api.types.pandas_dtype(constants.STRING_DTYPE)
+            return table.to_pandas(types_mapper={pa.string(): string_dtype, pa.large_string(): string_dtype}.get)
+        return compact_strings(pd.read_csv(path, usecols=columns))
+
+
+def write_table(df, path):
+    """
+    Write df in the configured STORAGE_FORMAT and return the path it was written to.
+    """
+    stored_path = table_path(path)
+    with profiling.timer("io"):
+        if stored_path.endswith(".parquet"):
+            df.to_parquet(stored_path, index=False, compression=constants.PARQUET_COMPRESSION)
+        else:
+            df.to_csv(stored_path, index=False)
+        write_metadata(stored_path, len(df), table_schema(df))
+    return stored_path
+
+
+def write_csv(df, path):
+    """
+    Write df as CSV whatever the STORAGE_FORMAT, e.g. for deliverables, with its sidecar.
+    """
+    with profiling.timer("io"):
+        df.to_csv(path, index=False)
+        write_metadata(path, len(df), table_schema(df))
+    return path
+
+
+def stored_size(path):
+    """
+    Size in bytes of a stored table, 0 if it doesn't exist.
+    """
+    for candidate in (table_path(path), path):
+        if os.path.exists(candidate):
+            return os.path.getsize(candidate)
+    return 0
+
+
+def count_rows(path):
+    """
+    Number of rows of a stored table, from its sidecar, else the parquet footer, else by counting
+    the lines of the CSV (which takes a quoted newline for the end of a row).
+    """
+    metadata = read_metadata(path)
+    if metadata is not None:
+        return metadata["rows"]
+    with profiling.timer("io"):
+        if path.endswith(".parquet"):
+            import pyarrow.parquet as pq
+            return pq.ParquetFile(path).metadata.num_rows
+        lines = 0
+        last_block = b""
+        with open(path, "rb") as file:
+            for block in iter(lambda: file.read(1 << 20), b""):
+                lines += block.count(b"\n")
+                last_block = block
+        # a last line without a newline, less the header
+        if last_block and not last_block.endswith(b"\n"):
+            lines += 1
+        return max(lines - 1, 0)
+
+
+class TableWriter:
+    """
+    Write a table page by page in the configured STORAGE_FORMAT, without holding it in memory.
+    The file is written next to its destination and only moved into place by close().
+    """
+
+    def __init__(self, path, columns):
+        self.path = table_path(path)
+        self.columns = columns
+        self.rows = 0
+        self._temporary_path = self.path + ".partial"
+        self._parquet_writer = None
+        self._schema = None
+        self._table_schema = None
+
+    def write(self, df):
+        if df.empty:
+            return
+        with profiling.timer("io"):
+            self._write(df)
+
+    def _write(self, df):
+        df = df[self.columns]
+        if self._table_schema is None:
+            self._table_schema = table_schema(df)
+        if self.path.endswith(".parquet"):
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+            if self._parquet_writer is None:
+                # columns that are all null on the first page are typed as strings
+                schema = pa.Schema.from_pandas(df, preserve_index=False)
+                self._schema = pa.schema([
+                    field.with_type(pa.string()) if pa.types.is_null(field.type) else field for field in schema
+                ])
+                self._parquet_writer = pq.ParquetWriter(
+                    self._temporary_path, self._schema, compression=constants.PARQUET_COMPRESSION
+                )
+            self._parquet_writer.write_table(pa.Table.from_pandas(df, schema=self._schema, preserve_index=False))
+        else:
+            df.to_csv(self._temporary_path, mode="a" if self.rows else "w", header=not self.rows, index=False)
+        self.rows += len(df)
+
+    def close(self):
+        if self._parquet_writer is not None:
+            self._parquet_writer.close()
+        elif self.rows == 0:
+            write_table(pd.DataFrame(columns=self.columns), self.path)
+            return self.path
+        os.replace(self._temporary_path, self.path)
+        with profiling.timer("io"):
+            write_metadata(self.path, self.rows, self._table_schema)
+        return self.path
+
+
+class SortedCsvWriter:
+    """
+    Write rows to a CSV sorted by a numeric column, without holding them all in memory.
+    Rows are buffered and spilled as sorted runs of run_rows, which close() merges into path.
+    The sort is stable: rows with the same value keep the order they were written in.
+    """
+
+    def __init__(self, path, columns, sort_column, run_rows):
+        self.path = path
+        self.columns = columns
+        self.sort_column = sort_column
+        self.run_rows = run_rows
+        self.rows = 0
+        self._buffer = []
+        self._runs = []
+
+    def write_rows(self, rows):
+        self._buffer.extend(rows)
+        self.rows += len(rows)
+        if len(self._buffer) >= self.run_rows:
+            self._runs.append(self._spill(f"{self.path}.run{len(self._runs)}"))
+
+    def _spill(self, path):
+        df = pd.DataFrame(self._buffer, columns=self.columns).sort_values(by=self.sort_column, kind="stable")
+        with profiling.timer("io"):
+            df.to_csv(path, index=False)
+        self._buffer = []
+        return path
+
+    def close(self):
+        if not self._runs:
+            # everything fit in one run
+            self._spill(self.path)
+            self._write_metadata()
+            return self.path
+        self._runs.append(self._spill(f"{self.path}.run{len(self._runs)}"))
+        sort_index = self.columns.index(self.sort_column)
+        with profiling.timer("io"):
+            files = [open(run, "r", newline="") for run in self._runs]
+            try:
+                readers = [csv.reader(file) for file in files]
+                for reader in readers:
+                    next(reader)
+                with open(self.path, "w", newline="") as output:
+                    writer = csv.writer(output, lineterminator="\n")
+                    writer.writerow(self.columns)
+                    # heapq.merge takes the earlier run first on ties, which keeps the sort stable
+                    writer.writerows(heapq.merge(*readers, key=lambda row: float(row[sort_index])))
+            finally:
+                for file in files:
+                    file.close()
+        for run in self._runs:
+            os.remove(run)
+        self._write_metadata()
+        return self.path
+
+    def _write_metadata(self):
+        # the merged file is only typed by its columns
+        with profiling.timer("io"):
+            write_metadata(self.path, self.rows, {column: None for column in self.columns})
+
+
+class BucketStore:
+    """
+    In-memory tables shared by the stages of one run, keyed by resolved file path, so every spelling
+    of a path (and every first character of the misc bucket) shares one copy.
+    Each table is read once; stages hand modified tables back with put() and persist() writes them out.
+    Once the tables take more than max_bytes, the least recently used ones are evicted, and modified
+    tables are written out before they are dropped. The table just read is always kept.
+    """
+
+    def __init__(self, max_bytes=None):
+        self.max_bytes = max_bytes if max_bytes is not None else constants.BUCKET_CACHE_BYTES
+        self.tables = OrderedDict()
+        self.sizes = {}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.evicted_bytes = 0
+        self.peak_bytes = 0
+        self._paths = {}
+        self._writers = {}
+
+    def __contains__(self, path):
+        return os.path.realpath(path) in self.tables
+
+    @property
+    def size(self):
+        return sum(self.sizes.values())
+
+    def get(self, path, read=read_table):
+        key = os.path.realpath(path)
+        if key in self.tables:
+            self.hits += 1
+            self.tables.move_to_end(key)
+            return self.tables[key]
+        self.misses += 1
+        df = read(path)
+        self._add(key, path, df)
+        return df
+
+    def put(self, path, df, write=write_table):
+        # write(df, path) is called by persist(), or when the table is evicted
+        key = os.path.realpath(path)
+        self._writers[key] = write
+        self._add(key, path, df)
+
+    def _add(self, key, path, df):
+        self.tables[key] = df
+        self.tables.move_to_end(key)
+        self._paths[key] = path
+        # deep, to count the strings of object columns
+        self.sizes[key] = int(df.memory_usage(index=True, deep=True).sum())
+        self.peak_bytes = max(self.peak_bytes, self.size)
+        self._evict()
+
+    def _evict(self):
+        while self.size > self.max_bytes and len(self.tables) > 1:
+            key, df = self.tables.popitem(last=False)
+            if key in self._writers:
+                with profiling.timer("io"):
+                    self._writers.pop(key)(df, self._paths[key])
+            self.evictions += 1
+            self.evicted_bytes += self.sizes.pop(key)
+            del self._paths[key]
+            profiling.count("bucket_store_evictions")
+
+    def persist(self):
+        """
+        Write every table modified since the last persist() and return their paths.
+        """
+        persisted = []
+        for key, write in self._writers.items():
+            with profiling.timer("io"):
+                write(self.tables[key], self._paths[key])
+            persisted.append(self._paths[key])
+        self._writers = {}
+        return persisted
+
+    def stats(self):
+        return {
+            "tables": len(self.tables),
+            "bytes": self.size,
+            "peak_bytes": self.peak_bytes,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "evicted_bytes": self.evicted_bytes,
+        }
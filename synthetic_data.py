@@ -0,0 +1,140 @@
+import os
+import json
+import argparse
+import numpy as np
+import pandas as pd
+import constants
+import storage
+from get_sql_results import BRAND_COLUMNS, get_brand_prefixes
+
+# Share of brands starting with each letter, roughly as in a US product catalogue
+LETTER_WEIGHTS = {
+    "A": 6.5, "B": 7.0, "C": 7.5, "D": 4.5, "E": 3.0, "F": 3.5, "G": 4.0, "H": 4.0, "I": 2.5, "J": 1.5,
+    "K": 2.5, "L": 4.0, "M": 6.5, "N": 3.0, "O": 2.0, "P": 6.0, "Q": 0.3, "R": 4.0, "S": 9.5, "T": 5.0,
+    "U": 1.0, "V": 2.0, "W": 3.0, "X": 0.2, "Y": 0.5, "Z": 0.8,
+}
+SYLLABLES = ["an", "el", "is", "or", "ka", "lo", "mi", "ne", "ra", "so", "tu", "vi", "ze", "po", "da", "gi",
+             "fu", "he", "ja", "qu", "wy", "xo", "ba", "ce", "ri", "tex", "ton", "ix", "ly", "co"]
+ACCENTS = str.maketrans({"a": "á", "e": "é", "o": "ö", "u": "ü", "i": "í"})
+ASIN_ALPHABET = np.array(list("0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZ"))
+
+
+def make_brand(rng):
+    """
+    One brand name: a few syllables after a letter drawn from LETTER_WEIGHTS,
+    with the accented, hyphenated, plus-sign and non-letter forms seen in the extracts
+    """
+    letters = list(LETTER_WEIGHTS)
+    weights = np.array(list(LETTER_WEIGHTS.values()))
+    brand = rng.choice(letters, p=weights / weights.sum()).lower()
+    brand += "".join(rng.choice(SYLLABLES, size=rng.integers(1, 4)))
+    if rng.random() < 0.3:
+        brand += " " + "".join(rng.choice(SYLLABLES, size=rng.integers(1, 3)))
+    kind = rng.random()
+    if kind < 0.06:
+        brand = brand.translate(ACCENTS)
+    elif kind < 0.12:
+        brand += "-" + "".join(rng.choice(SYLLABLES, size=2))
+    elif kind < 0.15:
+        brand += "+"
+    elif kind < 0.18:
+        brand = f"{rng.integers(1, 1000)} {brand}"
+    elif kind < 0.20:
+        brand = "&" + brand
+    elif kind < 0.22:
+        brand = f"'{brand}'"
+    return brand
+
+
+# spellings of the same brand that preprocess_brand maps to one string, and how often each is used
+VARIANT_WEIGHTS = np.array([0.45, 0.25, 0.2, 0.05, 0.05])
+
+
+def brand_variants(brand):
+    return [brand, brand.upper(), brand.title(), f"  {brand}  ", f'"{brand.upper()}"']
+
+
+def make_asins(rng, size):
+    # "B0" followed by 8 random base 36 digits
+    digits = rng.integers(0, len(ASIN_ALPHABET), size=(size, 8))
+    return np.char.add("B0", np.ascontiguousarray(ASIN_ALPHABET[digits]).view("<U8").ravel())
+
+
+def generate(directory, rows, seed=0, chunk_size=1_000_000):
+    """
+    Write a synthetic dataset with about `rows` brand rows under directory, laid out like a real run:
+    the prefix tables in DATA_DIRECTORY, the source brand and sales rank files and the manual clusters
+    in MAPPINGS_DIRECTORY.
+    Brand popularity is heavy tailed, so a few brands have many ASINs and most have a handful.
+    Returns the number of rows written per prefix.
+    """
+    rng = np.random.default_rng(seed)
+    os.makedirs(os.path.join(directory, constants.DATA_DIRECTORY), exist_ok=True)
+    os.makedirs(os.path.join(directory, constants.MAPPINGS_DIRECTORY), exist_ok=True)
+    brands = [make_brand(rng) for _ in range(max(100, rows // 20))]
+    variants = np.array([variant for brand in brands for variant in brand_variants(brand)], dtype=object)
+    variants_per_brand = len(variants) // len(brands)
+
+    writers = {
+        key: storage.TableWriter(os.path.join(directory, constants.DATA_DIRECTORY, file_name), BRAND_COLUMNS)
+        for key, file_name in constants.BRAND_PREFIX_TO_FILE_NAME.items()
+    }
+    for start in range(0, rows, chunk_size):
+        size = min(chunk_size, rows - start)
+        popularity = (rng.pareto(1.2, size=size) * len(brands) / 50).astype(np.int64) % len(brands)
+        variant = popularity * variants_per_brand + rng.choice(variants_per_brand, size=size, p=VARIANT_WEIGHTS)
+        chunk = pd.DataFrame({"brand": variants[variant], "asin": make_asins(rng, size)})
+        # some products are listed under several brand strings, and some have no brand
+        relisted = rng.random(size) < 0.05
+        chunk.loc[relisted, "asin"] = np.roll(chunk["asin"].to_numpy(), 1)[relisted]
+        chunk.loc[rng.random(size) < 0.01, "brand"] = None
+        chunk = chunk.drop_duplicates()
+        # brands are split like get_sql_results does, missing brands go to misc
+        prefixes = get_brand_prefixes(chunk["brand"].fillna(""))
+        for key, bucket in chunk.groupby(prefixes):
+            writers[key].write(bucket)
+    row_counts = {}
+    for key, writer in writers.items():
+        writer.close()
+        row_counts[key] = writer.rows
+
+    # source brand strings: mostly spellings of generated brands, some unknown to the extracts
+    source_rows, rank_rows = [], []
+    for brand_id in range(1000, 1000 + max(50, rows // 200)):
+        for _ in range(rng.integers(1, 4)):
+            if rng.random() < 0.8:
+                popularity = int(rng.pareto(1.2) * len(brands) / 50) % len(brands)
+                source_rows.append((brand_id, rng.choice(brand_variants(brands[popularity]), p=VARIANT_WEIGHTS)))
+            else:
+                source_rows.append((brand_id, make_brand(rng) + "x"))
+        rank_rows.append((brand_id, int(rng.integers(1, 1000)) if rng.random() < 0.95 else None))
+    for data_source in constants.DATA_SOURCES:
+        pd.DataFrame(source_rows, columns=["brand_id", "brand"]).to_csv(
+            os.path.join(directory, constants.get_source_brands_file(data_source)), index=False
+        )
+    pd.DataFrame(rank_rows, columns=["product_brand_id", "product_symbol_id"]).astype("Int64").to_csv(
+        os.path.join(directory, constants.SALES_RANK_CSV), index=False
+    )
+    # manual clusters hold preprocessed strings, which for plain ASCII letters is just the upper-cased brand
+    plain_brands = [brand for brand in brands if brand.replace(" ", "").isascii() and brand.replace(" ", "").isalpha()]
+    manual_clusters = {
+        f"{rng.integers(1, 1000)},{90000 + position}": [brand.upper(), "NOBRAND"]
+        for position, brand in enumerate(plain_brands[:20])
+    }
+    with open(os.path.join(directory, constants.MANUAL_CLUSTERS_JSON), "w") as file:
+        json.dump(manual_clusters, file, indent=4)
+    return row_counts
+
+
+def main():
+    parser = argparse.ArgumentParser(description="generate a synthetic brand dataset")
+    parser.add_argument("directory", help="directory to write data/ and mappings/ into")
+    parser.add_argument("--rows", type=int, default=100_000, help="number of brand rows (10k to 50M)")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    row_counts = generate(args.directory, args.rows, args.seed)
+    print(f"{sum(row_counts.values())} rows written to {args.directory}")
+
+
+if __name__ == "__main__":
+    main()
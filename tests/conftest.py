@@ -0,0 +1,37 @@
+import os
+import sys
+
+# the pipeline modules live at the top of the repository
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pytest
+
+
+@pytest.fixture
+def pipeline_directory(tmp_path, monkeypatch):
+    """
+    A small synthetic dataset, preprocessed and clustered, as the current directory.
+    """
+    import constants
+    import synthetic_data
+    import main
+    synthetic_data.generate(str(tmp_path), 3000, seed=1)
+    monkeypatch.chdir(tmp_path)
+    os.makedirs(constants.DEDUPLICATE_BRAND_DIR, exist_ok=True)
+    main.preprocess_data(1, force=True)
+    for data_source in constants.DATA_SOURCES:
+        main.get_brand_id_map(data_source)
+    return tmp_path
+
+
+@pytest.fixture
+def profiled(monkeypatch):
+    """
+    Record profiling spans in memory for the test, yielding the list of top-level spans.
+    """
+    import profiling
+    spans = []
+    monkeypatch.setattr(profiling, "_enabled", True)
+    monkeypatch.setattr(profiling, "_spans", spans)
+    monkeypatch.setattr(profiling, "_open_spans", [])
+    yield spans
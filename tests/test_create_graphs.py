@@ -0,0 +1,25 @@
+import numpy as np
+import pandas as pd
+import create_graphs
+from query_client import LocalQueryClient
+
+
+def test_purina_batches_keep_the_quarters_of_their_own_rows(monkeypatch):
+    brands = [f"PURINA {index:02d}" for index in range(12)]
+    quarters = pd.date_range("2021-01-01", periods=6, freq="QS").strftime("%Y-%m-%d")
+    rows = [(brand, quarter, float(index)) for index, brand in enumerate(brands) for quarter in quarters[:3]]
+    # only the second batch has the last quarters, one of them without sales
+    rows += [(brands[11], quarters[4], np.nan), (brands[10], quarters[5], 1.0), ("OTHER", quarters[3], 1.0)]
+    purina_df = pd.DataFrame(rows, columns=["product_brand", "quarter", "total_price_paid"])
+    jobs = []
+    monkeypatch.setattr(create_graphs, "render_charts", lambda batch_jobs, workers: jobs.extend(batch_jobs))
+
+    create_graphs.purina(LocalQueryClient(lambda sql: purina_df.copy()), workers=1)
+
+    # the pivot of each batch's rows, as the charts were drawn before
+    purina_df["quarter"] = pd.to_datetime(purina_df["quarter"])
+    for (_, (batch, batch_pivot, _)), batch_brands in zip(jobs, [brands[:10], brands[10:]]):
+        batch_df = purina_df[purina_df["product_brand"].isin(batch_brands)]
+        expected = batch_df.pivot(index="quarter", columns="product_brand", values="total_price_paid")
+        pd.testing.assert_frame_equal(batch_pivot, expected)
+    assert len(jobs) == 2
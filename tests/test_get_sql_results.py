@@ -0,0 +1,132 @@
+import os
+import re
+import numpy as np
+import pandas as pd
+import pytest
+import constants
+import storage
+import get_sql_results
+from query_client import CachedQueryClient, LocalQueryClient
+
+
+class Upstream:
+    """
+    Handler for LocalQueryClient answering the incremental extraction queries from a (brand, asin) frame,
+    like BigQuery would.
+    """
+
+    def __init__(self, rows):
+        self.df = pd.DataFrame(rows, columns=["brand", "asin"])
+
+    def __call__(self, sql):
+        df = self.df.assign(
+            prefix=get_sql_results.get_brand_prefixes(self.df["brand"]),
+            shard=get_sql_results.get_asin_shards(self.df["asin"]),
+        )
+        if "FARM_FINGERPRINT" in sql:
+            hashes = pd.util.hash_pandas_object(df[["brand", "asin"]], index=False).to_numpy()
+            return pd.DataFrame([
+                (prefix, shard, len(rows), int(np.bitwise_xor.reduce(hashes[rows.index]).view(np.int64)))
+                for (prefix, shard), rows in df.groupby(["prefix", "shard"])
+            ], columns=["prefix", "shard", "row_count", "fingerprint"])
+        # the whole prefixes, then the prefix:shard keys the rows query selects
+        prefixes, shard_keys = [re.findall(r"'([^']*)'", values) for values in re.findall(r"\) IN \(([^)]*)\)", sql)]
+        selected = df["prefix"].isin(prefixes) | (df["prefix"] + ":" + df["shard"]).isin(shard_keys)
+        return df[selected][["prefix", "brand", "asin"]].reset_index(drop=True)
+
+
+def prefix_rows(prefix):
+    path = os.path.join(constants.DATA_DIRECTORY, constants.BRAND_PREFIX_TO_FILE_NAME[prefix])
+    df = storage.read_table(path)
+    return sorted((brand, None if pd.isna(asin) else asin) for brand, asin in zip(df["brand"], df["asin"]))
+
+
+def upstream_rows(upstream, prefix):
+    df = upstream.df[get_sql_results.get_brand_prefixes(upstream.df["brand"]) == prefix]
+    return sorted((brand, None if pd.isna(asin) else asin) for brand, asin in zip(df["brand"], df["asin"]))
+
+
+@pytest.fixture
+def extract_directory(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    os.makedirs(constants.DATA_DIRECTORY, exist_ok=True)
+    return tmp_path
+
+
+ROWS = [
+    ("ACME", "B000000011"),
+    ("ACME", "B000000012"),
+    ("APEX", "B000000021"),
+    ("ACMEX", None),
+    ("BOLT", "B000000011"),
+    ("123 GO", "B000000099"),
+]
+
+
+def test_incremental_extraction_sees_changes_through_the_query_cache(extract_directory):
+    upstream = Upstream(ROWS)
+    client = CachedQueryClient(LocalQueryClient(upstream), directory=str(extract_directory / "cache"))
+    get_sql_results.get_brands_url_data_incremental(client)
+    upstream.df = pd.concat([upstream.df, pd.DataFrame([("AZURE", "B000000031")], columns=["brand", "asin"])])
+    assert get_sql_results.get_brands_url_data_incremental(client) == ["A"]
+    assert prefix_rows("A") == upstream_rows(upstream, "A")
+
+
+def file_mtimes():
+    return {
+        prefix: os.stat(storage.existing_path(os.path.join(constants.DATA_DIRECTORY, file_name))).st_mtime_ns
+        for prefix, file_name in constants.BRAND_PREFIX_TO_FILE_NAME.items()
+    }
+
+
+def test_first_incremental_extraction_fetches_every_prefix(extract_directory):
+    upstream = Upstream(ROWS)
+    updated = get_sql_results.get_brands_url_data_incremental(LocalQueryClient(upstream))
+    assert updated == list(constants.BRAND_PREFIX_TO_FILE_NAME)
+    for prefix in constants.BRAND_PREFIX_TO_FILE_NAME:
+        assert prefix_rows(prefix) == upstream_rows(upstream, prefix)
+
+
+def test_unchanged_shards_are_not_fetched_again(extract_directory):
+    upstream = Upstream(ROWS)
+    client = LocalQueryClient(upstream)
+    get_sql_results.get_brands_url_data_incremental(client)
+    mtimes = file_mtimes()
+    client.queries.clear()
+    assert get_sql_results.get_brands_url_data_incremental(client) == []
+    # only the fingerprints were queried, and no file was rewritten
+    assert len(client.queries) == 1
+    assert file_mtimes() == mtimes
+
+
+def test_changed_and_deleted_shards_are_merged(extract_directory):
+    upstream = Upstream(ROWS)
+    client = LocalQueryClient(upstream)
+    get_sql_results.get_brands_url_data_incremental(client)
+    mtimes = file_mtimes()
+    df = upstream.df
+    upstream.df = pd.concat([
+        # BOLT's only row is deleted, which empties its shard, and ACME gets a row in an existing shard
+        df[df["brand"] != "BOLT"],
+        pd.DataFrame([("ACME", "B000000111"), ("CRANE", "B000000077")], columns=["brand", "asin"]),
+    ], ignore_index=True)
+    updated = get_sql_results.get_brands_url_data_incremental(client)
+    assert sorted(updated) == ["A", "B", "C"]
+    for prefix in constants.BRAND_PREFIX_TO_FILE_NAME:
+        assert prefix_rows(prefix) == upstream_rows(upstream, prefix)
+    # the rows of unchanged shards are kept, e.g. A's null ASIN, and unchanged prefixes aren't rewritten
+    assert ("ACMEX", None) in prefix_rows("A")
+    changed = file_mtimes()
+    assert all(changed[prefix] == mtimes[prefix] for prefix in constants.BRAND_PREFIX_TO_FILE_NAME if prefix not in updated)
+
+
+def test_changed_shards_only_fetch_their_rows(extract_directory):
+    upstream = Upstream(ROWS)
+    client = LocalQueryClient(upstream)
+    get_sql_results.get_brands_url_data_incremental(client)
+    upstream.df = pd.concat([upstream.df, pd.DataFrame([("ACME", "B000000111")], columns=["brand", "asin"])])
+    fetched = []
+    client.handler = lambda sql: fetched.append(upstream(sql)) or fetched[-1]
+    get_sql_results.get_brands_url_data_incremental(client)
+    # the rows of shard A:11, not of the rest of A
+    assert sorted(fetched[-1]["asin"]) == ["B000000011", "B000000111"]
@@ -0,0 +1,104 @@
+import json
+import pandas as pd
+import pytest
+import constants
+import storage
+import main
+
+
+def test_match_brand_str_to_brand_id_fetches_each_bucket_once(pipeline_directory, profiled):
+    main.match_brand_str_to_brand_id("iri", write_output=False)
+    for bucket in profiled[0]["children"]:
+        counters = bucket["counters"]
+        # one lookup per bucket: a read, as the store starts empty
+        assert counters.get("preprocessed_data_cache_misses", 0) + counters.get("preprocessed_data_cache_hits", 0) == 1
+
+
+def match_cache_hits(spans):
+    return spans[-1]["counters"].get("match_cache_hits", 0)
+
+
+def test_tfidf_results_are_cached_per_candidate_count(pipeline_directory, profiled, monkeypatch):
+    main.find_nearest_match("iri", search_all_buckets=False, engine="tfidf")
+    main.find_nearest_match("iri", search_all_buckets=False, engine="tfidf")
+    assert match_cache_hits(profiled) > 0
+    # another candidate count can find other matches, so the cached results don't apply
+    monkeypatch.setattr(main.constants, "NEAREST_MATCH_NGRAM_CANDIDATES", 5)
+    main.find_nearest_match("iri", search_all_buckets=False, engine="tfidf")
+    assert match_cache_hits(profiled) == 0
+
+
+@pytest.fixture
+def null_asin_brand(pipeline_directory):
+    """
+    A brand without an ASIN in the A bucket, as the extraction's LEFT JOIN of product codes gives,
+    and a manual cluster for it.
+    """
+    path = constants.PREPROCESSED_FILE("A")
+    df = storage.read_table(path)
+    row = pd.DataFrame({"brand": ["ACMEX"], "asin": [None]}).astype(df.dtypes.to_dict())
+    storage.write_table(pd.concat([df, row], ignore_index=True), path)
+    with open(constants.MANUAL_CLUSTERS_JSON, "r") as file:
+        manual_clusters = json.load(file)
+    manual_clusters["1,99999"] = ["ACMEX"]
+    with open(constants.MANUAL_CLUSTERS_JSON, "w") as file:
+        json.dump(manual_clusters, file)
+    return "ACMEX"
+
+
+def test_nearest_matches_with_a_null_asin_are_cached(null_asin_brand):
+    main.find_nearest_match("iri", search_all_buckets=False, engine="blocking")
+    first = pd.read_csv(constants.CLOSEST_BRANDS_CSV, keep_default_na=False)
+    match = first[(first["iri_brand_string"] == null_asin_brand) & (first["found_brand_string"] == null_asin_brand)]
+    assert match["asin"].tolist() == [""]
+    # the second run answers from the match cache
+    main.find_nearest_match("iri", search_all_buckets=False, engine="blocking")
+    pd.testing.assert_frame_equal(pd.read_csv(constants.CLOSEST_BRANDS_CSV, keep_default_na=False), first)
+
+
+def test_fuzzy_exact_matches_with_a_null_asin_are_cached(null_asin_brand, monkeypatch):
+    monkeypatch.setattr(constants, "EXACT_MATCH_CUTOFF", 0.01)
+    first = main.match_brand_str_to_brand_id("iri", write_output=False)
+    second = main.match_brand_str_to_brand_id("iri", write_output=False)
+    pd.testing.assert_frame_equal(first, second)
+
+
+def test_preprocess_ascii_brands_matches_preprocess_brand():
+    brands = ["acme-co", "  Mr. O'Brien+Sons ", 'the "best"\tbrand', "a\x1fb\x0cc", "", "   ", "x--y++z"]
+    assert main.preprocess_ascii_brands(brands) == [main.preprocess_brand(brand) for brand in brands]
+
+
+def run_main(monkeypatch, *args):
+    monkeypatch.setattr("sys.argv", ["main.py", *args])
+    main.main()
+    return pd.read_csv(constants.DELIVERABLE_MAPPED_BRANDS_CSV, keep_default_na=False)
+
+
+def test_map_data_after_editing_manual_clusters_starts_from_the_preprocessed_buckets(pipeline_directory, monkeypatch):
+    run_main(monkeypatch, "--map_data")
+    brand, asin = storage.read_table(constants.PREPROCESSED_FILE("B")).iloc[0]
+    with open(constants.MANUAL_CLUSTERS_JSON, "r") as file:
+        manual_clusters = json.load(file)
+    manual_clusters["1,99999"] = [brand]
+    with open(constants.MANUAL_CLUSTERS_JSON, "w") as file:
+        json.dump(manual_clusters, file)
+
+    rerun = run_main(monkeypatch, "--map_data")
+    assert asin in rerun["asin"].tolist()
+    # the same as mapping freshly preprocessed buckets
+    run_main(monkeypatch, "--preprocess", "--force")
+    pd.testing.assert_frame_equal(rerun, run_main(monkeypatch, "--map_data", "--force"))
+    # and nothing changed since
+    assert run_main(monkeypatch, "--map_data").equals(rerun)
+
+
+def test_nearest_matches_without_the_match_cache_do_not_hash_the_buckets(pipeline_directory, monkeypatch):
+    main.find_nearest_match("iri", search_all_buckets=True, engine="blocking")
+    expected = pd.read_csv(constants.CLOSEST_BRANDS_CSV, keep_default_na=False)
+    monkeypatch.setattr(constants, "MATCH_CACHE_DB", None)
+
+    def table_hash(tables):
+        raise AssertionError("hashed the buckets without a match cache")
+    monkeypatch.setattr(main.match_cache, "table_hash", table_hash)
+    main.find_nearest_match("iri", search_all_buckets=True, engine="blocking")
+    pd.testing.assert_frame_equal(pd.read_csv(constants.CLOSEST_BRANDS_CSV, keep_default_na=False), expected)
@@ -0,0 +1,38 @@
+import numpy as np
+from rapidfuzz import distance
+import matching
+
+
+def brute_force(choices, query, score_cutoff):
+    return [
+        position for position, choice in enumerate(choices)
+        if distance.JaroWinkler.distance(query, choice) <= score_cutoff
+    ]
+
+
+def test_blocking_candidates_cover_strings_longer_than_255_characters():
+    choices = ["A" * 600, "A" * 300 + "B" * 300, "B" * 600, "A" * 599 + "C", "SHORT"]
+    index = matching.BlockingIndex(choices)
+    for query in ("A" * 600, "A" * 590 + "B" * 10, "B" * 600):
+        candidates = set(index.candidates(query, 0.15).tolist())
+        assert set(brute_force(choices, query, 0.15)) <= candidates
+    assert 0 in index.candidates("A" * 600, 0.15).tolist()
+
+
+def test_blocking_candidates_with_saturated_counts():
+    # counts past the signature cap only bound the characters in common from below
+    choices = ["A" * 70_000, "B" * 10]
+    index = matching.BlockingIndex(choices)
+    assert index.saturated
+    assert 0 in index.candidates("A" * 70_000, 0.15).tolist()
+
+
+def test_character_signatures_count_past_255():
+    signatures = matching.character_signatures(["A" * 600])
+    assert signatures[0, matching.SIGNATURE_CLASSES["A"]] == 600
+    assert signatures.dtype == np.uint16
+
+
+def test_ngram_index_of_choices_shorter_than_an_ngram_has_no_candidates():
+    index = matching.NgramIndex(["X", "Y", None])
+    assert list(index.search(["X", "XYZ"], score_cutoff=0.5)) == [[], []]
@@ -0,0 +1,96 @@
+import os
+import time
+import pandas as pd
+import pytest
+from query_client import CachedQueryClient, LocalQueryClient, normalize_sql, query_key
+
+
+class Counter:
+    # handler returning how many times each query was run
+    def __init__(self):
+        self.runs = {}
+
+    def __call__(self, sql):
+        self.runs[sql] = self.runs.get(sql, 0) + 1
+        return pd.DataFrame({"runs": [self.runs[sql]]})
+
+
+@pytest.fixture
+def counter():
+    return Counter()
+
+
+@pytest.fixture
+def cached(tmp_path, counter):
+    return CachedQueryClient(LocalQueryClient(counter), directory=str(tmp_path), ttl_seconds=60)
+
+
+def runs(client, sql):
+    return int(client.query_dataframe(sql)["runs"].iloc[0])
+
+
+def test_normalize_sql_drops_comments_before_collapsing_whitespace():
+    assert normalize_sql("a -- c\nb") == "a b"
+    assert normalize_sql("a -- c b") == "a"
+    assert query_key("a -- c\nb") != query_key("a -- c b")
+    assert normalize_sql("SELECT  x /* note\n */ FROM t  # trailing\n;") == "SELECT x FROM t"
+    # quoted strings and identifiers are kept as they are
+    assert normalize_sql("SELECT '--  x', `a  b`") == "SELECT '--  x', `a  b`"
+
+
+def test_repeated_queries_are_answered_from_the_cache(cached):
+    assert runs(cached, "SELECT 1") == 1
+    assert runs(cached, "SELECT   1 -- again") == 1
+    assert [page["runs"].tolist() for page in cached.query_pages("SELECT 1")] == [[1]]
+
+
+def test_expired_results_are_run_again(cached):
+    runs(cached, "SELECT 1")
+    old = time.time() - 120
+    os.utime(cached.path("SELECT 1"), (old, old))
+    assert runs(cached, "SELECT 1") == 2
+    # and cached again
+    assert runs(cached, "SELECT 1") == 2
+
+
+def test_refresh_reruns_and_replaces_cached_results(tmp_path, counter, cached):
+    runs(cached, "SELECT 1")
+    refreshing = CachedQueryClient(LocalQueryClient(counter), directory=str(tmp_path), refresh=True)
+    assert runs(refreshing, "SELECT 1") == 2
+    assert runs(cached, "SELECT 1") == 2
+
+
+def test_invalidate_by_query_and_by_table(cached):
+    runs(cached, "SELECT * FROM `project.dataset.mapped`")
+    runs(cached, "SELECT * FROM `project.dataset.other`")
+    runs(cached, "SELECT 2")
+    assert cached.invalidate("SELECT 2") == 1
+    assert cached.invalidate(table="project.dataset.mapped") == 1
+    assert runs(cached, "SELECT * FROM `project.dataset.mapped`") == 2
+    assert runs(cached, "SELECT * FROM `project.dataset.other`") == 1
+    assert cached.invalidate() == 2
+
+
+def test_failed_queries_are_not_cached(tmp_path):
+    def fail(sql):
+        raise RuntimeError("query failed")
+    client = CachedQueryClient(LocalQueryClient(fail), directory=str(tmp_path))
+    with pytest.raises(RuntimeError):
+        list(client.query_pages("SELECT 1"))
+    assert os.listdir(tmp_path) == []
+
+
+def test_run_queries_runs_concurrently_and_keeps_the_order_of_the_names():
+    import threading
+    from query_client import run_queries
+    # every query waits for all of them to start, which only works if they run at once
+    started = threading.Barrier(3, timeout=10)
+
+    def handler(sql):
+        started.wait()
+        time.sleep(0.05 if sql == "SELECT 'first'" else 0)
+        return pd.DataFrame({"sql": [sql]})
+    client = LocalQueryClient(handler)
+    results = run_queries({"first": "SELECT 'first'", "second": "SELECT 'second'", "third": "SELECT 'third'"}, client)
+    assert list(results) == ["first", "second", "third"]
+    assert [df["sql"].iloc[0] for df in results.values()] == ["SELECT 'first'", "SELECT 'second'", "SELECT 'third'"]